@@ -1,21 +1,177 @@
+"""
+Throughput of the proxies, for each server, application and worker count.
+
+Each cell of the matrix starts a server, waits until it answers, loads it
+with the client, then stops it.  Cells can run side by side on a large
+machine, each on its own CPUs.  The matrix can be narrowed down, wrk
+replaced with the built-in load generator, and the simulated origin the
+proxies fetch from made slower, bigger or flakier, e.g.::
+
+    python benchmarks.py --servers=uvicorn --apps=raw,httpx --workers=1,4 --jobs=4
+    python benchmarks.py --client=loadgen --rate=5000
+    python benchmarks.py --origin="--latency=0.05 --tail_rate=0.01 --size=20000"
+"""
+
 import atexit
 import os
+import random
 import re
 import shlex
+import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-from dataclasses import dataclass
-
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, astuple, dataclass, replace
+from itertools import product
+from typing import Dict, List, Optional
+from urllib.parse import quote, urlencode
+
+import fire
 import psutil
 import requests
 from devtools import debug
 
+import history
+import stats
+
 DURATION = 30
-URL = "http://localhost:{port}/?url=http://localhost:8001/"
-CLIENT_CMD = 'wrk -t 10 -d {duration} "{url}"'
+URL = "http://localhost:{port}/?url={upstream}"
+# Seconds before wrk counts a request as timed out (its default is 2), as
+# loadgen does
+CLIENT_TIMEOUT = 10
+CLIENT_CMD = 'wrk -t 10 -d {duration} --timeout {timeout}s -s {script} "{url}"'
+
+# Simulated upstream the proxies fetch from (see origin.py); the size and
+# latency of its answers are set per cell in the query string
+ORIGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "origin.py")
+ORIGIN_PORT = 8001
+UPSTREAM_URL = f"http://localhost:{ORIGIN_PORT}/"
+
+# Multipliers of the size suffixes, e.g. ``--sizes=1KB,1MB,50MB``
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024**2, "MB": 1024**2}
+
+# Built-in load generator, used with `--client=loadgen`; it may also send a
+# constant request `rate` (see loadgen.py)
+LOADGEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadgen.py")
+LOADGEN_CMD = (
+    '{python} {loadgen} --url="{url}" --duration={duration} '
+    "--connections={connections} --processes={processes}"
+)
+# Connections of both clients (wrk's default)
+CONNECTIONS = 10
+
+# Seconds between two samples of the resources used by a server
+SAMPLE_INTERVAL = 0.5
+
+# wrk script printing the latency distribution and the errors once done;
+# wrk's own --latency report has no 99.9th percentile
+WRK_SCRIPT = "wrk_report.lua"
+WRK_REPORT = """
+done = function(summary, latency, requests)
+  for _, p in ipairs({{"p50", 50}, {"p90", 90}, {"p99", 99}, {"p999", 99.9}}) do
+    io.write(string.format("latency_%s: %d\\n", p[1], latency:percentile(p[2])))
+  end
+  io.write(string.format("latency_max: %d\\n", latency.max))
+  local errors = summary.errors
+  io.write(string.format("errors: %d\\n",
+    errors.connect + errors.read + errors.write + errors.status))
+  io.write(string.format("timeouts: %d\\n", errors.timeout))
+  io.write(string.format("bytes: %d\\n", summary.bytes))
+  io.write(string.format("duration: %d\\n", summary.duration))
+end
+"""
+
+WORKERS = [1, 2, 4, 8, 16]
+
+# Seconds of load before each measured run, for the pools, caches and
+# allocators of the server to warm up; not measured
+WARMUP = 5
+
+# Runs of each cell, in random order across the cells, so that drifts of the
+# machine spread over all of them
+REPETITIONS = 3
+
+# Each run goes to RESULT_FILE, and the statistics of each cell to
+# SUMMARY_FILE, with its configuration
+RESULT_FILE = "results.csv"
+SUMMARY_FILE = "summary.csv"
+CONFIG_HEADER = "Type;Label;App;Workers;Upstream;Client;Rate;Size;Latency;Command"
+
+# CPUs of a cell given to the client; the server gets one per worker
+CLIENT_CPUS = 2
+
+# Seconds a server may take to start answering, or to stop
+READY_TIMEOUT = 60
+STOP_TIMEOUT = 30
+
+# Seconds between two readiness checks, growing up to the maximum
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+# Protocols the proxies using the shared httpx client may talk to the origin
+# (see upstream.PROTOCOL), and those they do unless told otherwise: origin.py
+# only speaks HTTP/1.1, so "http2" needs an `--upstream` accepting HTTP/2
+# cleartext, and "auto" one offering HTTP/2 over TLS
+UPSTREAM_PROTOCOLS = ["http1", "http2", "auto"]
+DEFAULT_UPSTREAM_PROTOCOLS = ["http1"]
+
+
+@dataclass
+class Results:
+    # Requests per second
+    speed: float = -1.0
+    # Latency percentiles and maximum, in milliseconds
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+    p999: Optional[float] = None
+    max: Optional[float] = None
+    # Requests failing, answered with an error status, or timing out
+    errors: int = 0
+    timeouts: int = 0
+    # Bytes received per second
+    transfer: Optional[float] = None
+    # Resources used by all the processes of the server during the run: CPU
+    # seconds, and the average number of CPUs this kept busy
+    cpu_seconds: Optional[float] = None
+    cpu_cores: Optional[float] = None
+    # Total resident memory at its peak, its median over the second half of
+    # the run, and before the run once warmed up, in MB
+    rss_peak: Optional[float] = None
+    rss_steady: Optional[float] = None
+    rss_idle: Optional[float] = None
+    ctx_switches: Optional[int] = None
+    max_fds: Optional[int] = None
+    max_sockets: Optional[int] = None
+    # Requests answered per CPU second, and MB of steady memory above the
+    # idle one per 1000 client connections
+    requests_per_cpu_second: Optional[float] = None
+    mb_per_1k_in_flight: Optional[float] = None
+
+    @classmethod
+    def parse_wrk(cls, output: str) -> "Results":
+        results = cls()
+        values = dict(re.findall(r"^(\w+): ([0-9.]+)$", output, re.MULTILINE))
+        m = re.search("Requests/sec:.*?([0-9.]+)", output)
+        if m:
+            results.speed = float(m.group(1))
+        for name in ("p50", "p90", "p99", "p999", "max"):
+            value = values.get(f"latency_{name}")
+            if value is not None:
+                # wrk counts in microseconds
+                setattr(results, name, float(value) / 1000)
+        results.errors = int(values.get("errors", 0))
+        results.timeouts = int(values.get("timeouts", 0))
+        seconds = float(values.get("duration", 0)) / 1e6
+        if seconds > 0:
+            results.transfer = float(values["bytes"]) / seconds
+        return results
 
 
 @dataclass
@@ -23,11 +179,28 @@ class Server:
     app: str
     port: int
     workers: int
+    upstream_protocol: str = "http1"
+    duration: int = DURATION
+    warmup: int = WARMUP
+    # "wrk" or "loadgen"
+    client: str = "wrk"
+    # Requests per second sent by loadgen, or None for a closed loop
+    rate: Optional[float] = None
+    # Body size in bytes and latency in seconds of the upstream responses,
+    # or None for those of the origin's profile
+    size: Optional[int] = None
+    latency: Optional[float] = None
     # cmd_tpl: str = ""
 
     @property
     def cmd(self):
-        return self.cmd_tpl.format(app=self.app, port=self.port, workers=self.workers)
+        return self.cmd_tpl.format(
+            app=self.app, port=self.port, workers=self.workers, pidfile=self.pidfile
+        )
+
+    @property
+    def pidfile(self):
+        return f"server-{self.port}.pid"
 
     @property
     def args(self):
@@ -35,89 +208,182 @@ class Server:
 
     @property
     def url(self):
-        return URL.format(port=self.port)
+        query = {}
+        if self.size is not None:
+            query["size"] = self.size
+        if self.latency is not None:
+            query["latency"] = self.latency
+        upstream = UPSTREAM_URL
+        if query:
+            upstream += "?" + urlencode(query)
+        return URL.format(port=self.port, upstream=quote(upstream, safe=""))
 
     @property
-    def client_cmd(self):
-        return CLIENT_CMD.format(duration=DURATION, url=self.url)
-
-    def run_bench(self) -> float:
-        self.assert_stopped()
-
-        self.start()
-
-        time.sleep(1)
-        self.assert_started()
+    def ready_url(self):
+        # Quick to answer whatever the cell's size and latency
+        return URL.format(port=self.port, upstream=quote(UPSTREAM_URL, safe=""))
 
-        assert int(open("server.pid").read()) == self.process.pid
+    @property
+    def variant(self) -> str:
+        """Upstream protocol, size and latency, for the logs and reports."""
+        parts = [self.upstream_protocol]
+        if self.size is not None:
+            parts.append(f"size={format_size(self.size)}")
+        if self.latency is not None:
+            parts.append(f"latency={self.latency}s")
+        return " ".join(parts)
+
+    def client_cmd(self, processes: int = 1, duration: Optional[int] = None) -> str:
+        duration = duration or self.duration
+        if self.client == "loadgen":
+            cmd = LOADGEN_CMD.format(
+                python=sys.executable,
+                loadgen=LOADGEN,
+                url=self.url,
+                duration=duration,
+                connections=CONNECTIONS,
+                processes=processes,
+            )
+            if self.rate:
+                cmd += f" --rate={self.rate}"
+            return cmd
+        return CLIENT_CMD.format(
+            duration=duration,
+            timeout=CLIENT_TIMEOUT,
+            script=WRK_SCRIPT,
+            url=self.url,
+        )
 
-        client = self.start_benchmark()
-        speed = self.get_results(client)
-        time.sleep(1)
+    def run_bench(self, cpus: List[int] = ()) -> Results:
+        """Benchmark the server, on `cpus` if given."""
+        server_cpus, client_cpus = split_cpus(cpus)
+        self.assert_stopped()
 
-        (gone, alive) = kill_proc_tree(self.process.pid)
-        # debug(gone, alive)
-        assert not alive
+        with pinned(server_cpus):
+            self.start()
+        try:
+            self.wait_until_ready()
+
+            assert int(open(self.pidfile).read()) == self.process.pid
+
+            if self.warmup:
+                with pinned(client_cpus):
+                    self.start_benchmark(len(client_cpus) or 1, self.warmup)
+
+            sampler = TreeSampler(self.process.pid)
+            sampler.start()
+            try:
+                with pinned(client_cpus):
+                    client = self.start_benchmark(len(client_cpus) or 1)
+            finally:
+                sampler.stop()
+            results = self.get_results(client)
+            sampler.add_to(results, CONNECTIONS)
+            if results.cpu_seconds is not None:
+                self.log(
+                    f"CPU: {results.cpu_seconds:.1f} s "
+                    f"({results.cpu_cores:.2f} cores), "
+                    f"RSS: {results.rss_steady:.1f} MB "
+                    f"(peak {results.rss_peak:.1f} MB)"
+                )
+        finally:
+            self.stop()
+
+        return results
+
+    def stop(self) -> None:
+        if self.process.poll() is None:
+            (gone, alive) = kill_proc_tree(self.process.pid)
+            # debug(gone, alive)
+            assert not alive
         self.kill()
-        time.sleep(1)
-
-        print("\n")
-
-        return speed
+        self.wait_until_stopped()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
 
     def start(self) -> None:
-        print(f"# Starting server: {self.cmd}")
+        self.log(f"Starting server: {self.cmd} (upstream: {self.variant})")
+        # Each run starts with an empty disk cache, and neither shares it nor
+        # its metrics with the runs beside it
+        self.data_dir = tempfile.mkdtemp(prefix="minij-bench-")
+        env = dict(
+            os.environ,
+            MINIJ_UPSTREAM_PROTOCOL=self.upstream_protocol,
+            MINIJ_CACHE_DIR=os.path.join(self.data_dir, "cache"),
+            MINIJ_METRICS_DIR=os.path.join(self.data_dir, "metrics"),
+        )
         self.process = subprocess.Popen(
-            self.args, stdout=subprocess.PIPE, stderr=devnull
+            self.args, stdout=devnull, stderr=devnull, env=env
         )
         child_processes.append(self.process)
 
     def kill(self) -> None:
-        print("# Shutting down server")
+        self.log("Shutting down server")
         self.process.kill()
         return_code = self.process.wait()
         assert return_code == self.process.returncode
-
-    def start_benchmark(self) -> subprocess.CompletedProcess:
-        print(f"# Starting benchmark")
-        client_args = shlex.split(self.client_cmd)
+        if os.path.exists(self.pidfile):
+            os.unlink(self.pidfile)
+
+    def start_benchmark(
+        self, processes: int = 1, duration: Optional[int] = None
+    ) -> subprocess.CompletedProcess:
+        """Run the client, for `duration` seconds if given: a warmup."""
+        if duration:
+            self.log(f"Warming up ({duration}s)")
+        else:
+            self.log(f"Starting benchmark ({self.client})")
+        client_args = shlex.split(self.client_cmd(processes, duration))
         # debug(client_args)
         client = subprocess.run(client_args, capture_output=True)
         return client
 
-    def get_results(self, client) -> float:
-        lines = client.stdout.decode("utf-8").split("\n")
-        for line in lines:
-            m = re.match("Requests/sec:.*?([0-9.]+)", line)
-            if m:
-                speed = float(m.group(1))
-                print(f"Speed: {speed} req/s")
-                return speed
-        return -1.0
+    def get_results(self, client) -> Results:
+        results = Results.parse_wrk(client.stdout.decode("utf-8"))
+        self.log(
+            f"Speed: {results.speed} req/s, p50: {results.p50} ms, "
+            f"p99: {results.p99} ms, p99.9: {results.p999} ms, "
+            f"errors: {results.errors}, timeouts: {results.timeouts}"
+        )
+        return results
+
+    def wait_until_ready(self) -> None:
+        """Wait until the server answers, instead of guessing how long it takes."""
+
+        def ready():
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.process.returncode}")
+            try:
+                return requests.get(self.ready_url, timeout=1).status_code == 200
+            except requests.RequestException:
+                return False
+
+        if not poll(ready, READY_TIMEOUT):
+            raise RuntimeError(f"Server not ready after {READY_TIMEOUT}s")
+        self.log("Server ready")
 
-    def assert_started(self):
-        r = requests.get(self.url)
-        assert r.status_code == 200
+    def wait_until_stopped(self) -> None:
+        if not poll(lambda: not is_listening(self.port), STOP_TIMEOUT):
+            raise RuntimeError(f"Server still listening after {STOP_TIMEOUT}s")
 
     def assert_stopped(self):
-        try:
-            r = requests.get(self.url)
+        if is_listening(self.port):
             raise AssertionError("Server is not stopped")
-        except:
-            pass
+
+    def log(self, message: str) -> None:
+        print(f"[{self.port}] {message}", flush=True)
 
 
 class Gunicorn(Server):
     type = "wsgi"
     label = "Gunicorn"
-    cmd_tpl = "gunicorn -b localhost:{port} --pid server.pid -w {workers} {app}"
+    cmd_tpl = "gunicorn -b localhost:{port} --pid {pidfile} -w {workers} {app}"
 
 
 class Uwsgi(Server):
     type = "wsgi"
     label = "uWsgi"
     cmd_tpl = (
-        "uwsgi --pidfile server.pid --http localhost:{port} -w {app} -L -p {workers}"
+        "uwsgi --pidfile {pidfile} --http localhost:{port} -w {app} -L -p {workers}"
     )
 
 
@@ -125,7 +391,7 @@ class GunicornUvicorn(Server):
     type = "asgi"
     label = "Gunicorn+Uvicorn"
     cmd_tpl = (
-        "gunicorn -b localhost:{port} --pid server.pid "
+        "gunicorn -b localhost:{port} --pid {pidfile} "
         "-k uvicorn.workers.UvicornWorker -w {workers} {app}"
     )
 
@@ -134,7 +400,7 @@ class Hypercorn(Server):
     type = "asgi"
     label = "Hypercorn"
     cmd_tpl = (
-        "hypercorn -b localhost:{port} --pid server.pid -w {workers} -k uvloop {app}"
+        "hypercorn -b localhost:{port} --pid {pidfile} -w {workers} -k uvloop {app}"
     )
 
 
@@ -146,6 +412,7 @@ APPLICATIONS = {
         "minij_proxy_asgi_starlette:app",
         "minij_proxy_asgi_aiohttp:application",
         "minij_proxy_asgi_httpx:application",
+        "minij_proxy_asgi_raw:application",
         "minij_proxy_falcon:app",
     ],
     "wsgi": [
@@ -154,47 +421,492 @@ APPLICATIONS = {
     ],
 }
 
+# Applications fetching through upstream.get_httpx_client()
+HTTPX_APPLICATIONS = {
+    "minij_proxy_asgi_starlette:app",
+    "minij_proxy_asgi_httpx:application",
+    "minij_proxy_asgi_raw:application",
+    "minij_proxy_falcon:app",
+}
+
 devnull = open("/dev/null", "wb")
 
 results = []
+results_lock = threading.Lock()
 child_processes = []
-result_file = open("results.csv", "w")
-result_file.write(f'Speed;Type;Label;App;Workers;Command"\n')
-result_file.flush()
-
-
-def main():
-    start_caddy()
-
+result_file = None
+# History the runs are appended to, and what they share
+store: Optional[history.Store] = None
+session_record: dict = {}
+
+
+def main(
+    servers=None,
+    apps=None,
+    workers=WORKERS,
+    jobs=1,
+    duration=DURATION,
+    client="wrk",
+    rate=None,
+    origin="",
+    sizes=None,
+    latencies=None,
+    warmup=WARMUP,
+    repetitions=REPETITIONS,
+    seed=None,
+    store_file=history.STORE_FILE,
+    protocols=None,
+    upstream=None,
+):
+    """Benchmark the servers × apps × workers matrix, `jobs` cells at a time.
+
+    `servers` and `apps` keep the servers and applications whose label or
+    name contains one of the given strings (case-insensitive).  `sizes` (in
+    bytes, or with a KB or MB suffix) and `latencies` (in seconds) of the
+    upstream responses add dimensions to the matrix, e.g.
+    ``--sizes=1KB,1MB,50MB --latencies=0,0.1,2``.  With
+    ``--client=loadgen``, the built-in load generator replaces wrk, and
+    sends `rate` requests per second if given.  `origin` holds the options
+    of the simulated upstream, e.g. ``--origin="--latency=0.05 --size=20000"``.
+    `upstream` is the URL of another origin to fetch from instead, such as
+    one speaking HTTP/2 for the proxies using httpx to talk to it, with e.g.
+    ``--protocols=http1,http2,auto``.
+
+    Each cell runs `repetitions` times, after `warmup` seconds of load each
+    time, in an order shuffled with `seed`.  The runs go to results.csv, and
+    the statistics of each cell to summary.csv, both rewritten each time;
+    they are also appended to the `store_file` history, where sessions can
+    be compared (see history.py).
+    """
+    if client not in ("wrk", "loadgen"):
+        raise ValueError(f"Unknown client: {client!r}")
+    if rate and client != "loadgen":
+        raise ValueError("Only loadgen sends requests at a given rate")
+    protocols = as_list(protocols) or DEFAULT_UPSTREAM_PROTOCOLS
+    unknown = set(protocols) - set(UPSTREAM_PROTOCOLS)
+    if unknown:
+        raise ValueError(f"Unknown protocols: {', '.join(sorted(unknown))}")
+    if protocols != ["http1"] and not upstream:
+        raise ValueError("The simulated origin only speaks HTTP/1.1: set --upstream")
+    global result_file, store, session_record, UPSTREAM_URL
+    store = history.Store(store_file)
+    session_record = {
+        "session": history.new_session(),
+        "commit": history.git_commit(),
+        "host": history.host_fingerprint(),
+        "options": dict(
+            servers=as_list(servers),
+            apps=as_list(apps),
+            workers=as_list(workers),
+            jobs=jobs,
+            duration=duration,
+            client=client,
+            rate=rate,
+            origin=origin,
+            sizes=as_list(sizes),
+            latencies=as_list(latencies),
+            warmup=warmup,
+            repetitions=repetitions,
+            seed=seed,
+            protocols=protocols,
+            upstream=upstream,
+        ),
+    }
+    print(f"# Session {session_record['session']} ({session_record['commit']})")
+    result_file = open(RESULT_FILE, "w")
+    result_file.write(
+        "Speed;P50;P90;P99;P99.9;Max;Errors;Timeouts;Transfer;"
+        "CPU seconds;CPU cores;Peak RSS;Steady RSS;Idle RSS;Context switches;Max fds;"
+        "Max sockets;Requests/CPU second;MB/1k in flight;"
+        f"Cell;Run;{CONFIG_HEADER}\n"
+    )
+    result_file.flush()
+    with open(WRK_SCRIPT, "w") as script:
+        script.write(WRK_REPORT)
+
+    if upstream:
+        UPSTREAM_URL = upstream
+    else:
+        start_origin(origin)
+
+    options = dict(duration=duration, warmup=warmup, client=client, rate=rate)
+    cells = make_cells(
+        as_list(servers),
+        as_list(apps),
+        as_list(workers),
+        [parse_size(size) for size in as_list(sizes)] or [None],
+        [float(latency) for latency in as_list(latencies)] or [None],
+        protocols,
+        options,
+    )
+    runs = [
+        (cell, repetition)
+        for repetition in range(repetitions)
+        for cell in range(len(cells))
+    ]
+    random.Random(seed).shuffle(runs)
+    print(f"# {len(cells)} cells × {repetitions} runs, {jobs} at a time")
+    cpu_pool = CpuPool(available_cpus())
+    try:
+        with ThreadPoolExecutor(jobs) as executor:
+            for i, (cell, repetition) in enumerate(runs):
+                # Runs of a cell may overlap, each needs its own port
+                server = replace(cells[cell], port=8100 + 2 * i)
+                executor.submit(run_cell, server, cell, repetition, cpu_pool)
+    except KeyboardInterrupt:
+        sys.exit()
+
+    summaries = summarize_cells(cells, results)
+    write_summaries(cells, summaries)
+    report_results(cells, summaries)
+
+
+def make_cells(
+    servers, apps, workers, sizes, latencies, protocols, options
+) -> List[Server]:
+    """Servers of the matrix, created with the `options` of all cells."""
+    cells = []
     port = 8100
-    for workers in [1, 2, 4, 8, 16]:
+    for worker_count in workers:
         for server_class in SERVER_CLASSES:
+            if not matches(server_class.label, servers):
+                continue
             for application in APPLICATIONS[server_class.type]:
-                server = server_class(application, port, workers)
-                port += 1
+                if not matches(application, apps):
+                    continue
+                for protocol, size, latency in product(
+                    upstream_protocols(application, protocols), sizes, latencies
+                ):
+                    cells.append(
+                        server_class(
+                            application,
+                            port,
+                            worker_count,
+                            protocol,
+                            size=size,
+                            latency=latency,
+                            **options,
+                        )
+                    )
+                    port += 2
+    return cells
+
+
+def parse_size(value) -> int:
+    """Bytes of a size given as a number or with a suffix, such as ``50MB``."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KkMm]?[Bb]?)\s*", str(value))
+    if match is None:
+        raise ValueError(f"Invalid size: {value!r}")
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def format_size(size: int) -> str:
+    for unit in ("MB", "KB"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+def run_cell(server: Server, cell: int, repetition: int, cpu_pool: "CpuPool") -> None:
+    cpus = cpu_pool.acquire(server.workers + CLIENT_CPUS)
+    try:
+        bench_results = server.run_bench(cpus)
+    except Exception:
+        traceback.print_exc()
+        return
+    finally:
+        cpu_pool.release(cpus)
+
+    options = session_record["options"]
+    with results_lock:
+        results.append((cell, bench_results))
+        values = ";".join("" if v is None else str(v) for v in astuple(bench_results))
+        result_file.write(f"{values};{cell};{repetition};{config_columns(server)}\n")
+        result_file.flush()
+        store.append(
+            dict(
+                session_record,
+                time=time.time(),
+                cell=dict(
+                    asdict(server),
+                    type=server.type,
+                    label=server.label,
+                    cmd=server.cmd,
+                    # The origin answers differently with other options
+                    origin=" ".join(sorted(shlex.split(options["origin"]))),
+                    upstream=options["upstream"],
+                ),
+                index=cell,
+                repetition=repetition,
+                results=asdict(bench_results),
+            )
+        )
 
-                try:
-                    speed = server.run_bench()
-                    results.append((speed, server.cmd))
 
-                    result_file.write(
-                        f'{speed};{server.type};{server.label};{server.app};{server.workers};"{server.cmd}"\n'
-                    )
-                    result_file.flush()
-                except KeyboardInterrupt:
-                    sys.exit()
-                except:
-                    traceback.print_exc()
-                port += 1
+def config_columns(server: Server) -> str:
+    rate = server.rate or ""
+    size = "" if server.size is None else server.size
+    latency = "" if server.latency is None else server.latency
+    return f'{server.type};{server.label};{server.app};{server.workers};{server.upstream_protocol};{server.client};{rate};{size};{latency};"{server.cmd}"'
 
-    report_results(results)
+
+@dataclass
+class CellSummary:
+    speed: stats.Summary
+    p99: Optional[stats.Summary]
+    errors: int
+    requests_per_cpu_second: Optional[float]
+    rss_steady: Optional[float]
+    # Whether the cell is faster than the next slower one beyond the noise;
+    # None if unknown, with a single run
+    distinguishable: Optional[bool] = None
+
+
+def summarize_cells(cells: List[Server], results) -> Dict[int, CellSummary]:
+    """Statistics of the runs of each cell that answered, by cell index."""
+    runs: Dict[int, List[Results]] = {}
+    for cell, bench_results in results:
+        if bench_results.speed >= 0:
+            runs.setdefault(cell, []).append(bench_results)
+    summaries = {}
+    for cell, cell_runs in runs.items():
+        p99s = [r.p99 for r in cell_runs if r.p99 is not None]
+        efficiencies = [
+            r.requests_per_cpu_second
+            for r in cell_runs
+            if r.requests_per_cpu_second is not None
+        ]
+        rss = [r.rss_steady for r in cell_runs if r.rss_steady is not None]
+        summaries[cell] = CellSummary(
+            speed=stats.summarize([r.speed for r in cell_runs]),
+            p99=stats.summarize(p99s),
+            errors=sum(r.errors for r in cell_runs),
+            requests_per_cpu_second=median(efficiencies),
+            rss_steady=median(rss),
+        )
+    ranked = sorted(summaries.values(), key=lambda s: s.speed.mean, reverse=True)
+    for faster, slower in zip(ranked, ranked[1:]):
+        faster.distinguishable = stats.distinguishable(faster.speed, slower.speed)
+    return summaries
 
 
-def start_caddy():
-    print("# Starting Caddy server")
-    cmd = "caddy file-server -listen localhost:8001 --root static"
-    caddy = subprocess.Popen(shlex.split(cmd), stdout=devnull, stderr=devnull)
-    child_processes.append(caddy)
+def median(values: List[float]) -> Optional[float]:
+    return stats.summarize(values).median if values else None
+
+
+def write_summaries(cells: List[Server], summaries: Dict[int, CellSummary]) -> None:
+    with open(SUMMARY_FILE, "w") as summary_file:
+        summary_file.write(
+            "Cell;Runs;Speed mean;Speed median;Speed stddev;Speed CI95;"
+            "P99 mean;P99 median;P99 stddev;P99 CI95;Errors;"
+            "Requests/CPU second;Steady RSS;Distinguishable from next;"
+            f"{CONFIG_HEADER}\n"
+        )
+        for cell, summary in sorted(summaries.items()):
+            speed, p99 = summary.speed, summary.p99
+            values = [cell, speed.n, speed.mean, speed.median, speed.stdev, speed.ci95]
+            if p99 is None:
+                values += [None] * 4
+            else:
+                values += [p99.mean, p99.median, p99.stdev, p99.ci95]
+            values += [
+                summary.errors,
+                summary.requests_per_cpu_second,
+                summary.rss_steady,
+                summary.distinguishable,
+            ]
+            columns = ";".join("" if v is None else str(v) for v in values)
+            summary_file.write(f"{columns};{config_columns(cells[cell])}\n")
+
+
+def matches(name: str, patterns) -> bool:
+    return not patterns or any(p.lower() in name.lower() for p in patterns)
+
+
+def as_list(value) -> list:
+    """Command line values: fire passes ``a,b`` as a tuple, ``a`` as is."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+class CpuPool:
+    """CPUs of the machine, handed out to the cells running at the same time."""
+
+    def __init__(self, cpus: List[int]):
+        self.cpus = list(cpus)
+        self.free = list(cpus)
+        self.condition = threading.Condition()
+
+    def acquire(self, count: int) -> List[int]:
+        """Wait until `count` CPUs are free, or all of them for larger cells."""
+        count = min(count, len(self.cpus))
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.free) >= count)
+            cpus, self.free = self.free[:count], self.free[count:]
+        return cpus
+
+    def release(self, cpus: List[int]) -> None:
+        with self.condition:
+            self.free = sorted(self.free + list(cpus))
+            self.condition.notify_all()
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cpus(cpus: List[int]):
+    """CPUs of the server and of the client, among those of a cell."""
+    if len(cpus) <= CLIENT_CPUS:
+        return cpus, cpus
+    return cpus[:-CLIENT_CPUS], cpus[-CLIENT_CPUS:]
+
+
+@contextmanager
+def pinned(cpus: List[int]):
+    """Run the processes started in the block on `cpus` only.
+
+    Linux sets the affinity of the calling thread, which the processes it
+    starts inherit, so cells running in other threads are not affected.
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def poll(condition, timeout: float) -> bool:
+    """Wait until `condition()` is true, checking less and less often."""
+    deadline = time.monotonic() + timeout
+    interval = POLL_INTERVAL
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return True
+
+
+def is_listening(port: int) -> bool:
+    try:
+        requests.get(f"http://localhost:{port}/", timeout=1)
+    except requests.ConnectionError:
+        return False
+    except requests.RequestException:
+        pass
+    return True
+
+
+def upstream_protocols(application, protocols):
+    if application in HTTPX_APPLICATIONS:
+        return protocols
+    # The others only speak HTTP/1.1 to the origin
+    return ["http1"]
+
+
+def start_origin(options: str = ""):
+    print(f"# Starting simulated origin {options}")
+    cmd = [sys.executable, ORIGIN, f"--port={ORIGIN_PORT}"] + shlex.split(options)
+    origin = subprocess.Popen(cmd, stdout=devnull)
+    child_processes.append(origin)
+    if not poll(lambda: is_listening(ORIGIN_PORT), READY_TIMEOUT):
+        raise RuntimeError("Origin not ready")
+
+
+class TreeSampler:
+    """Samples the resources used by a process and its descendants."""
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL):
+        self.root = psutil.Process(pid)
+        self.interval = interval
+        # Last CPU seconds and context switches of each process, so that
+        # processes exiting during the run still count
+        self.cpu: Dict[int, float] = {}
+        self.ctx_switches: Dict[int, int] = {}
+        self.rss: List[int] = []
+        self.max_fds = 0
+        self.max_sockets = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.sample()
+        self.start_time = time.monotonic()
+        self.start_cpu = sum(self.cpu.values())
+        self.start_ctx_switches = sum(self.ctx_switches.values())
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        self.elapsed = time.monotonic() - self.start_time
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        try:
+            processes = [self.root] + self.root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        rss = fds = sockets = 0
+        for process in processes:
+            try:
+                with process.oneshot():
+                    times = process.cpu_times()
+                    switches = process.num_ctx_switches()
+                    rss += process.memory_info().rss
+                    fds += process.num_fds()
+                    sockets += len(inet_connections(process))
+            except psutil.Error:
+                # Exited, or not ours
+                continue
+            self.cpu[process.pid] = times.user + times.system
+            self.ctx_switches[process.pid] = switches.voluntary + switches.involuntary
+        self.rss.append(rss)
+        self.max_fds = max(self.max_fds, fds)
+        self.max_sockets = max(self.max_sockets, sockets)
+
+    def add_to(self, results: Results, connections: int) -> None:
+        """Set the resource figures of `results`, for `connections` clients."""
+        if not self.rss:
+            return
+        mb = 1024 * 1024
+        cpu_seconds = sum(self.cpu.values()) - self.start_cpu
+        steady = sorted(self.rss[len(self.rss) // 2 :])
+        results.cpu_seconds = cpu_seconds
+        results.cpu_cores = cpu_seconds / self.elapsed
+        results.rss_peak = max(self.rss) / mb
+        results.rss_steady = steady[len(steady) // 2] / mb
+        # The first sample is taken before the client starts
+        results.rss_idle = self.rss[0] / mb
+        results.ctx_switches = sum(self.ctx_switches.values()) - self.start_ctx_switches
+        results.max_fds = self.max_fds
+        results.max_sockets = self.max_sockets
+        if cpu_seconds > 0 and results.speed > 0:
+            results.requests_per_cpu_second = results.speed * self.elapsed / cpu_seconds
+        in_flight = results.rss_steady - results.rss_idle
+        results.mb_per_1k_in_flight = in_flight * 1000 / connections
+
+
+def inet_connections(process: psutil.Process) -> list:
+    # Renamed in psutil 6
+    if hasattr(process, "net_connections"):
+        return process.net_connections(kind="inet")
+    return process.connections(kind="inet")
 
 
 def kill_proc_tree(
@@ -220,10 +932,39 @@ def kill_proc_tree(
     return (gone, alive)
 
 
-def report_results(results):
-    results.sort(reverse=True)
-    for speed, cmd in results:
-        print(f"{speed:>10} | {cmd}")
+def report_results(cells: List[Server], summaries: Dict[int, CellSummary]):
+    """Print the cells from the fastest.
+
+    "≈" marks the cells not distinguishable from the next one, "?" those with
+    a single run.
+    """
+    print(
+        f"{'req/s':>10} | {'± 95%':>8} | {'median':>10} | {'stddev':>8} | "
+        f"{'p99':>8} | {'errors':>7} | {'req/cpu-s':>9} | {'RSS MB':>8} | "
+        f"  | command"
+    )
+    ranked = sorted(summaries.items(), key=lambda item: item[1].speed.mean)
+    for cell, summary in reversed(ranked):
+        speed, server = summary.speed, cells[cell]
+        p99 = summary.p99.median if summary.p99 else None
+        efficiency = summary.requests_per_cpu_second
+        rss = summary.rss_steady
+        flag = {True: "", False: "≈", None: "?"}[summary.distinguishable]
+        if summary is ranked[0][1]:
+            # The slowest has no next one
+            flag = ""
+        print(
+            f"{speed.mean:>10.1f} | {format_optional(speed.ci95, '.1f'):>8} | "
+            f"{speed.median:>10.1f} | {format_optional(speed.stdev, '.1f'):>8} | "
+            f"{format_optional(p99, '.2f'):>8} | {summary.errors:>7} | "
+            f"{format_optional(efficiency, '.0f'):>9} | "
+            f"{format_optional(rss, '.1f'):>8} | {flag:1} | "
+            f"{server.cmd} [{server.variant}]"
+        )
+
+
+def format_optional(value: Optional[float], spec: str) -> str:
+    return "-" if value is None else format(value, spec)
 
 
 def reap_child_processes():
@@ -235,4 +976,5 @@ def reap_child_processes():
 
 atexit.register(reap_child_processes)
 
-main()
+if __name__ == "__main__":
+    fire.Fire(main)
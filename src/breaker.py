@@ -0,0 +1,167 @@
+"""
+Per-upstream-host circuit breakers.
+
+A host whose requests keep failing to connect or timing out gets its circuit
+opened: for `OPEN_SECONDS`, its requests fail at once with the status of its
+last failure (``523`` or ``524``), or are answered from a stale cached copy,
+instead of each waiting for a full timeout.  Then up to `HALF_OPEN_PROBES`
+requests are let through; the circuit closes again when they all succeed, and
+opens again on the first failure.
+
+Only failures to get an answer count: an upstream answering with an error
+status is up, as far as the breaker is concerned.
+"""
+
+import threading
+import time
+from typing import Dict
+
+from hostlimits import get_host
+
+# Statuses of the failures to reach an upstream (see upstream.error_status)
+FAILURE_STATUSES = frozenset([523, 524, 526])
+TIMEOUT_STATUS = 524
+
+# The circuit opens when at least this share of the requests of a window
+# failed, once the window has seen `MIN_REQUESTS` requests
+ERROR_RATE = 0.5
+MIN_REQUESTS = 20
+WINDOW = 10.0
+
+# ... or after this many timeouts in a row
+MAX_CONSECUTIVE_TIMEOUTS = 5
+
+# Seconds an open circuit fails fast before probing the host
+OPEN_SECONDS = 5.0
+
+# Requests let through at a time to probe a host, all of which must succeed
+HALF_OPEN_PROBES = 3
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_breakers: Dict[str, "CircuitBreaker"] = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    """The circuit of the upstream host is open: fail fast."""
+
+    def __init__(self, circuit: "CircuitBreaker"):
+        super().__init__(circuit.host)
+        self.status = circuit.failure_status
+        self.retry_after = circuit.retry_after()
+
+
+class CircuitBreaker:
+    """Circuit of one host, shared by coroutines and threads."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.state = CLOSED
+        self.failure_status = 523
+        self.opened = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.window_start = time.monotonic()
+        self.consecutive_timeouts = 0
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a request may go to the host; False means fail fast."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened < OPEN_SECONDS:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.probes = self.probe_successes = 0
+            if self.state == HALF_OPEN:
+                if self.probes >= HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    return False
+                self.probes += 1
+            return True
+
+    def check(self) -> None:
+        """Raise `CircuitOpen` unless a request may go to the host."""
+        if not self.allow():
+            raise CircuitOpen(self)
+
+    def record(self, status: int) -> None:
+        """Record the outcome of a request let through by `allow`."""
+        failed = status in FAILURE_STATUSES
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(status)
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= HALF_OPEN_PROBES:
+                        self._close()
+                return
+            if self.state == OPEN:
+                return
+
+            now = time.monotonic()
+            if now - self.window_start > WINDOW:
+                self.window_start = now
+                self.requests = self.failures = 0
+            self.requests += 1
+            if not failed:
+                self.consecutive_timeouts = 0
+                return
+            self.failures += 1
+            if status == TIMEOUT_STATUS:
+                self.consecutive_timeouts += 1
+            else:
+                self.consecutive_timeouts = 0
+            if self.consecutive_timeouts >= MAX_CONSECUTIVE_TIMEOUTS or (
+                self.requests >= MIN_REQUESTS
+                and self.failures >= ERROR_RATE * self.requests
+            ):
+                self._open(status)
+
+    def abandon(self) -> None:
+        """Forget a request let through by `allow` that got no outcome."""
+        with self._lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def retry_after(self) -> int:
+        """Seconds until the circuit lets requests through again."""
+        remaining = OPEN_SECONDS - (time.monotonic() - self.opened)
+        return max(1, int(remaining + 0.999))
+
+    def _open(self, status: int) -> None:
+        self.state = OPEN
+        self.failure_status = status
+        self.opened = time.monotonic()
+        self.trips += 1
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self.requests = self.failures = self.consecutive_timeouts = 0
+        self.window_start = time.monotonic()
+
+
+def get(url: str) -> CircuitBreaker:
+    host = get_host(url)
+    circuit = _breakers.get(host)
+    if circuit is None:
+        with _breakers_lock:
+            circuit = _breakers.setdefault(host, CircuitBreaker(host))
+    return circuit
+
+
+def stats() -> Dict[str, Dict]:
+    """State, requests failed fast and times opened so far, by host."""
+    return {
+        host: {"state": c.state, "rejected": c.rejected, "trips": c.trips}
+        for host, c in list(_breakers.items())
+    }
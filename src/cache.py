@@ -0,0 +1,362 @@
+"""
+In-process HTTP response cache, shared by all the requests of a worker.
+
+Follows the shared-cache rules of RFC 9111: freshness comes from
+``Cache-Control`` (``s-maxage``, then ``max-age``), ``Expires`` or, failing
+that, a ``Last-Modified`` heuristic; the current age accounts for the upstream
+``Age`` and ``Date`` headers; and a response carrying ``Vary`` is stored once
+per combination of the request headers it names.  Memory is bounded by the
+total size of the stored responses, evicting the least recently used first.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+# Total size of the stored responses, in bytes
+MAX_BYTES = 256 * 1024 * 1024
+
+# Responses larger than this are never stored
+MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Accounted for each entry on top of its body and headers
+ENTRY_OVERHEAD = 512
+
+# Statuses a shared cache may store (206 is not handled yet)
+CACHEABLE_STATUSES = frozenset([200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501])
+
+# Freshness given to responses with only a Last-Modified: a fraction of the
+# time since the last modification, capped
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 24 * 3600
+
+# Not stored: they describe a single connection, or a length recomputed when
+# the body is sent
+UNSTORED_HEADERS = frozenset(
+    [
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "transfer-encoding",
+        "upgrade",
+        "te",
+        "trailer",
+        "content-length",
+    ]
+)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Forbid serving a stale response (s-maxage implies proxy-revalidate)
+REVALIDATE_DIRECTIVES = frozenset(
+    ["must-revalidate", "proxy-revalidate", "s-maxage", "no-cache"]
+)
+
+ETAG_RE = re.compile(r'(?:W/)?"[^"]*"')
+
+Headers = List[Tuple[str, str]]
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    if not value:
+        return directives
+    for part in value.split(","):
+        name, sep, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if sep else None
+    return directives
+
+
+def parse_seconds(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(int(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def normalize_url(url: str) -> str:
+    """Lower-case scheme and host, drop the default port and the fragment."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = f"{userinfo}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def get_header(headers: Iterable[Tuple[str, str]], name: str) -> Optional[str]:
+    """Return the comma-joined values of header `name` (lower-case)."""
+    values = [v for k, v in headers if k.lower() == name]
+    return ", ".join(values) if values else None
+
+
+def vary_names(headers: Headers) -> Tuple[str, ...]:
+    value = get_header(headers, "vary") or ""
+    names = {name.strip().lower() for name in value.split(",")}
+    names.discard("")
+    return tuple(sorted(names))
+
+
+def vary_values(names: Tuple[str, ...], request_headers: Mapping[str, str]) -> Tuple:
+    values = []
+    for name in names:
+        value = request_headers.get(name)
+        if value is not None:
+            value = " ".join(value.split())
+        values.append(value)
+    return tuple(values)
+
+
+@dataclass
+class CacheEntry:
+    status: int
+    headers: Headers
+    vary: Tuple[str, ...]
+    body: bytes = b""
+    # Set instead of `body` when the body is a file of the disk cache
+    path: Optional[str] = None
+    # Time the response was received, and its age at that moment
+    response_time: float = 0.0
+    initial_age: float = 0.0
+    freshness_lifetime: float = 0.0
+    cache_control: Dict[str, Optional[str]] = field(default_factory=dict)
+    size: int = field(default=0, compare=False)
+
+    def current_age(self, now: Optional[float] = None) -> float:
+        if now is None:
+            now = time.time()
+        return self.initial_age + max(0.0, now - self.response_time)
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return self.freshness_lifetime > self.current_age(now)
+
+    def staleness(self, now: Optional[float] = None) -> float:
+        return self.current_age(now) - self.freshness_lifetime
+
+    def header(self, name: str) -> Optional[str]:
+        return get_header(self.headers, name)
+
+    def allows_stale(self, directive: str, now: Optional[float] = None) -> bool:
+        """Whether the entry may still be served stale under `directive`.
+
+        `directive` is ``stale-while-revalidate`` or ``stale-if-error``
+        (RFC 5861), both overridden by the revalidation directives.
+        """
+        if not REVALIDATE_DIRECTIVES.isdisjoint(self.cache_control):
+            return False
+        window = parse_seconds(self.cache_control.get(directive))
+        return window is not None and self.staleness(now) <= window
+
+    def validators(self) -> Dict[str, str]:
+        """Request headers revalidating this entry with the upstream."""
+        validators = {}
+        etag = self.header("etag")
+        if etag is not None:
+            validators["if-none-match"] = etag
+        last_modified = self.header("last-modified")
+        if last_modified is not None:
+            validators["if-modified-since"] = last_modified
+        return validators
+
+    def refresh(
+        self, headers: Headers, request_time: float, response_time: float
+    ) -> None:
+        """Update the entry from a ``304 Not Modified`` (RFC 9111, 4.3.4)."""
+        updated = {k.lower() for k, v in headers} - UNSTORED_HEADERS
+        self.headers = [(k, v) for k, v in self.headers if k.lower() not in updated]
+        self.headers += [(k, v) for k, v in headers if k.lower() in updated]
+        self.update_age(request_time, response_time)
+
+    def update_age(self, request_time: float, response_time: float) -> None:
+        self.cache_control = parse_cache_control(self.header("cache-control"))
+
+        date = parse_http_date(self.header("date"))
+        if date is None:
+            date = response_time
+        self.freshness_lifetime = freshness(self.cache_control, self.headers, date)
+
+        apparent_age = max(0.0, response_time - date)
+        age = parse_seconds(self.header("age")) or 0.0
+        corrected_age = age + (response_time - request_time)
+        self.initial_age = max(apparent_age, corrected_age)
+        self.response_time = response_time
+
+
+def make_entry(
+    status: int, headers: Headers, request_time: float, response_time: float
+) -> Optional[CacheEntry]:
+    """Build an empty-bodied entry for a response, or None if not storable."""
+    if status not in CACHEABLE_STATUSES:
+        return None
+
+    vary = vary_names(headers)
+    if "*" in vary:
+        return None
+
+    stored_headers = [(k, v) for k, v in headers if k.lower() not in UNSTORED_HEADERS]
+    entry = CacheEntry(status, stored_headers, vary)
+    entry.update_age(request_time, response_time)
+
+    if "no-store" in entry.cache_control or "private" in entry.cache_control:
+        return None
+    if entry.freshness_lifetime <= 0 and not entry.validators():
+        return None
+    return entry
+
+
+def is_not_modified(headers: Headers, request_headers: Mapping[str, str]) -> bool:
+    """Evaluate the client's conditional headers against a stored response.
+
+    ``If-None-Match`` (weak comparison) takes precedence over
+    ``If-Modified-Since``, as in RFC 9110, 13.2.2.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = get_header(headers, "etag")
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        return weak_etag(etag) in {
+            weak_etag(tag) for tag in ETAG_RE.findall(if_none_match)
+        }
+
+    if_modified_since = parse_http_date(request_headers.get("if-modified-since"))
+    if if_modified_since is None:
+        return False
+    last_modified = parse_http_date(get_header(headers, "last-modified"))
+    return last_modified is not None and last_modified <= if_modified_since
+
+
+def weak_etag(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def freshness(
+    cache_control: Dict[str, Optional[str]], headers: Headers, date: float
+) -> float:
+    if "no-cache" in cache_control:
+        return 0.0
+
+    for directive in ("s-maxage", "max-age"):
+        if directive in cache_control:
+            return parse_seconds(cache_control[directive]) or 0.0
+
+    expires_header = get_header(headers, "expires")
+    if expires_header is not None:
+        expires = parse_http_date(expires_header)
+        # An invalid Expires means "already expired"
+        return max(0.0, expires - date) if expires is not None else 0.0
+
+    last_modified = parse_http_date(get_header(headers, "last-modified"))
+    if last_modified is not None and last_modified < date:
+        return min(HEURISTIC_MAX, HEURISTIC_FRACTION * (date - last_modified))
+
+    return 0.0
+
+
+class ResponseCache:
+    """Byte-bounded LRU of `CacheEntry`, keyed on URL and varying headers.
+
+    `request_headers` are the headers sent to the upstream, with lower-case
+    names: those are what the upstream's ``Vary`` refers to.
+    """
+
+    def __init__(
+        self, max_bytes: int = MAX_BYTES, max_entry_bytes: int = MAX_ENTRY_BYTES
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Tuple, CacheEntry]" = OrderedDict()
+        # Vary of the last response stored for each URL, and how many
+        # entries are stored for it
+        self._vary: Dict[str, Tuple[str, ...]] = {}
+        self._variants: Dict[str, int] = {}
+        # The WSGI proxies run requests in threads
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(
+        self, url: str, request_headers: Mapping[str, str]
+    ) -> Optional[CacheEntry]:
+        """Return the stored entry, fresh or stale, or None."""
+        url = normalize_url(url)
+        with self._lock:
+            names = self._vary.get(url)
+            if names is None:
+                return None
+            key = (url, vary_values(names, request_headers))
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def store(
+        self, url: str, request_headers: Mapping[str, str], entry: CacheEntry
+    ) -> bool:
+        entry.size = (
+            len(entry.body)
+            + sum(len(k) + len(v) for k, v in entry.headers)
+            + ENTRY_OVERHEAD
+        )
+        if entry.size > self.max_entry_bytes or entry.size > self.max_bytes:
+            return False
+
+        url = normalize_url(url)
+        key = (url, vary_values(entry.vary, request_headers))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._vary[url] = entry.vary
+            self._entries[key] = entry
+            self._variants[url] = self._variants.get(url, 0) + 1
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def invalidate(self, url: str) -> None:
+        url = normalize_url(url)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == url]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._vary.clear()
+            self._variants.clear()
+            self.size = 0
+
+    def _remove(self, key: Tuple) -> None:
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        url = key[0]
+        self._variants[url] -= 1
+        if not self._variants[url]:
+            del self._variants[url]
+            del self._vary[url]
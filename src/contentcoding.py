@@ -0,0 +1,289 @@
+"""
+Content-coding negotiation between the clients, the proxy and the upstreams.
+
+The upstream is asked for the codings the client accepts (among those we
+support), and a body it sends encoded in one of them is passed through
+untouched.  Compressible bodies the upstream sent unencoded are compressed on
+the fly, as long as the worker's compression CPU budget allows it: once it
+runs out partway through a body, the rest is sent as uncompressed blocks of
+the same coding, which cost no more than an unencoded body.  Brotli and
+Zstandard are supported when the ``brotli`` and ``zstandard`` packages are
+installed.
+"""
+
+import struct
+import time
+import zlib
+from typing import AsyncIterator, List, Optional
+
+from cache import Headers, get_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Set to False to never compress bodies in the proxy
+COMPRESSING = True
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+# Bodies known to be smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+# Share of one CPU the worker may spend compressing, and the CPU seconds it
+# may spend in a burst
+CPU_SHARE = 0.25
+CPU_BURST = 1.0
+
+# Largest uncompressed block, within the limits of all the codings
+STORED_BLOCK_SIZE = 65535
+
+# Header of a Zstandard frame without content size, with a 64 KiB window
+ZSTD_FRAME_HEADER = b"\x28\xb5\x2f\xfd\x00\x30"
+
+# Most preferred first
+CODINGS = [
+    coding
+    for coding, available in [("br", brotli), ("zstd", zstandard), ("gzip", zlib)]
+    if available is not None
+]
+
+COMPRESSIBLE_TYPES = frozenset(
+    [
+        "application/javascript",
+        "application/json",
+        "application/manifest+json",
+        "application/xhtml+xml",
+        "application/xml",
+        "image/svg+xml",
+    ]
+)
+
+
+class CpuBudget:
+    """Token bucket of the CPU time spent compressing."""
+
+    def __init__(self, share: float = CPU_SHARE, burst: float = CPU_BURST):
+        self.share = share
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.spent = 0.0
+        self.refused = 0
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.share)
+        self.updated = now
+        if self.tokens > 0:
+            return True
+        self.refused += 1
+        return False
+
+    def spend(self, seconds: float) -> None:
+        self.tokens -= seconds
+        self.spent += seconds
+
+
+budget = CpuBudget()
+
+
+def negotiate(accept_encoding: Optional[str]) -> str:
+    """Return the codings of `CODINGS` accepted by the client, as a header.
+
+    The result is in our order of preference, or ``identity``, so that
+    clients accepting the same codings share cache entries.
+    """
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        name, _, value = params.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        qualities[coding] = q
+
+    default = qualities.get("*", 0.0)
+    accepted = [c for c in CODINGS if qualities.get(c, default) > 0]
+    return ", ".join(accepted) or "identity"
+
+
+def codings(value: str) -> List[str]:
+    return [c.strip() for c in value.split(",") if c.strip() != "identity"]
+
+
+def is_compressible(headers: Headers) -> bool:
+    content_type = get_header(headers, "content-type")
+    if content_type is None:
+        return False
+    mime_type = content_type.partition(";")[0].strip().lower()
+    return (
+        mime_type.startswith("text/")
+        or mime_type in COMPRESSIBLE_TYPES
+        or mime_type.endswith("+json")
+        or mime_type.endswith("+xml")
+    )
+
+
+def should_compress(headers: Headers) -> bool:
+    if not COMPRESSING or not is_compressible(headers):
+        return False
+    length = get_header(headers, "content-length")
+    if length is not None and length.isdigit() and int(length) < MIN_SIZE:
+        return False
+    return budget.available()
+
+
+def add_vary(headers: Headers) -> Headers:
+    """Add ``Accept-Encoding`` to the ``Vary`` of `headers`."""
+    vary = get_header(headers, "vary") or ""
+    if "accept-encoding" in vary.lower() or "*" in vary:
+        return headers
+    headers = [(k, v) for k, v in headers if k.lower() != "vary"]
+    headers.append(("vary", f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"))
+    return headers
+
+
+def encoded_headers(headers: Headers, coding: str) -> Headers:
+    """Headers of a response once compressed with `coding` by the proxy.
+
+    A compressed body is another representation: its entity tag is turned
+    into a weak one.
+    """
+    encoded = []
+    for k, v in headers:
+        name = k.lower()
+        if name in ("content-length", "content-encoding"):
+            continue
+        if name == "etag" and not v.startswith("W/"):
+            v = f"W/{v}"
+        encoded.append((k, v))
+    encoded.append(("content-encoding", coding))
+    return encoded
+
+
+def stored_representation(headers: Headers, stored: Headers) -> Headers:
+    """Adapt the headers of a ``304 Not Modified`` to the stored response.
+
+    The upstream describes its own representation: if the proxy compressed
+    the stored body, its ``ETag`` stays weak and its ``Vary`` keeps
+    ``Accept-Encoding``.
+    """
+    if "accept-encoding" in (get_header(stored, "vary") or "").lower():
+        if get_header(headers, "vary") is not None:
+            headers = add_vary(headers)
+    if (get_header(stored, "etag") or "").startswith("W/"):
+        headers = [
+            (k, f"W/{v}" if k.lower() == "etag" and not v.startswith("W/") else v)
+            for k, v in headers
+        ]
+    return headers
+
+
+def make_compressor(coding: str):
+    if coding == "br":
+        return brotli.Compressor(quality=BROTLI_QUALITY)
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def flush_for_stored(compressor, coding: str) -> bytes:
+    """End what `compressor` has compressed so far, on a byte boundary from
+    which uncompressed blocks of `coding` can follow."""
+    if coding == "br":
+        return compressor.flush()
+    if coding == "zstd":
+        # Zstandard frames can follow each other
+        return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH) + ZSTD_FRAME_HEADER
+    return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def stored_blocks(coding: str, data: bytes) -> bytes:
+    """`data` as uncompressed blocks of `coding`, after `flush_for_stored`."""
+    blocks = []
+    for start in range(0, len(data), STORED_BLOCK_SIZE):
+        block = data[start : start + STORED_BLOCK_SIZE]
+        size = len(block)
+        if coding == "br":
+            # Uncompressed meta-block: ISLAST=0, MNIBBLES=4, MLEN-1,
+            # ISUNCOMPRESSED=1 and padding
+            header = ((size - 1) << 3 | 1 << 19).to_bytes(3, "little")
+        elif coding == "zstd":
+            # Raw block, not the last
+            header = (size << 3).to_bytes(3, "little")
+        else:
+            # Deflate stored block, not the last
+            header = struct.pack("<BHH", 0, size, size ^ 0xFFFF)
+        blocks += [header, block]
+    return b"".join(blocks)
+
+
+def stored_end(coding: str, crc: int, size: int) -> bytes:
+    """End of a body of `coding` after its uncompressed blocks; a gzip body
+    ends with the `crc` and `size` of all the data."""
+    if coding == "br":
+        # ISLAST=1, ISLASTEMPTY=1
+        return b"\x03"
+    if coding == "zstd":
+        # Last raw block, empty
+        return b"\x01\x00\x00"
+    last_block = struct.pack("<BHH", 1, 0, 0xFFFF)
+    return last_block + struct.pack("<II", crc, size & 0xFFFFFFFF)
+
+
+async def compress(chunks: AsyncIterator[bytes], coding: str) -> AsyncIterator[bytes]:
+    """Compress a body with `coding` as it streams through.
+
+    The CPU time is charged to the budget chunk by chunk, and once it runs
+    out the rest of the body is sent in uncompressed blocks.
+    """
+    compressor = make_compressor(coding)
+    if coding == "br":
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        compress_chunk, finish = compressor.compress, compressor.flush
+    stored = False
+    # Of the whole body, for the trailer of a gzip one sent partly stored
+    crc = size = 0
+    try:
+        async for chunk in chunks:
+            if coding == "gzip":
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+            if stored:
+                data = stored_blocks(coding, chunk)
+            elif budget.available():
+                start = time.perf_counter()
+                data = compress_chunk(chunk)
+                budget.spend(time.perf_counter() - start)
+            else:
+                stored = True
+                data = flush_for_stored(compressor, coding)
+                data += stored_blocks(coding, chunk)
+            if data:
+                yield data
+        if stored:
+            yield stored_end(coding, crc, size)
+            return
+        start = time.perf_counter()
+        data = finish()
+        budget.spend(time.perf_counter() - start)
+        if data:
+            yield data
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,344 @@
+"""
+On-disk second tier of the response cache, shared by the workers of a host.
+
+Bodies are stored once per content, in files named after their SHA-256 under
+``bodies/``; a small SQLite index maps each URL and the values of its varying
+request headers to the response metadata and the digest of its body.  Both
+survive restarts, so a freshly started worker begins with a warm cache.
+
+Cached bodies are sent straight from their file (see `streaming.send_file`)
+instead of being read back into the worker's memory.  ``MINIJ_CACHE_DIR``
+moves the cache elsewhere, e.g. to give a server a cold one of its own.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import replace
+from typing import List, Mapping, Optional, Tuple, Union
+
+from cache import (
+    CacheEntry,
+    get_header,
+    normalize_url,
+    parse_cache_control,
+    vary_values,
+)
+
+DIRECTORY = os.environ.get("MINIJ_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "minij-proxy-cache"
+)
+
+# Total size of the stored bodies, in bytes
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Bodies larger than this are never stored
+MAX_ENTRY_BYTES = 512 * 1024 * 1024
+
+# The last access time of an entry, used for eviction, is only written back
+# when older than this many seconds
+TOUCH_INTERVAL = 60
+
+# Partial body files older than this are left over from a dead worker
+ORPHAN_AGE = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    vary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    url TEXT NOT NULL,
+    vary_values TEXT NOT NULL,
+    vary TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    response_time REAL NOT NULL,
+    initial_age REAL NOT NULL,
+    freshness_lifetime REAL NOT NULL,
+    digest TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (url, vary_values)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS bodies (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+"""
+
+
+class BodyWriter:
+    """Temporary file a body is written to as it streams through."""
+
+    def __init__(self, directory: str):
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def discard(self) -> None:
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class DiskCache:
+    """Content-addressed body files plus an SQLite index of the entries.
+
+    Several processes may use the same directory: body files are immutable
+    and moved in place atomically, and SQLite serializes the index updates.
+    """
+
+    def __init__(
+        self,
+        directory: str = DIRECTORY,
+        max_bytes: int = MAX_BYTES,
+        max_entry_bytes: int = MAX_ENTRY_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._db: Optional[sqlite3.Connection] = None
+        # Used from concurrent executor threads
+        self._lock = threading.RLock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._db is None:
+                self.open()
+            return self._db
+
+    def open(self) -> None:
+        os.makedirs(os.path.join(self.directory, "bodies"), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, "tmp"), exist_ok=True)
+        db = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"),
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        self._db = db
+        self._remove_orphans()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def body_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "bodies", digest[:2], digest)
+
+    def writer(self) -> BodyWriter:
+        # Opening the index creates the directories
+        self.db
+        return BodyWriter(os.path.join(self.directory, "tmp"))
+
+    def lookup(
+        self, url: str, request_headers: Mapping[str, str]
+    ) -> Optional[CacheEntry]:
+        """Return the stored entry, with its body in `CacheEntry.path`."""
+        url = normalize_url(url)
+        with self._lock:
+            row = self.db.execute(
+                "SELECT vary FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            values = json.dumps(vary_values(tuple(json.loads(row[0])), request_headers))
+            row = self.db.execute(
+                "SELECT vary, status, headers, response_time, initial_age,"
+                " freshness_lifetime, digest, accessed"
+                " FROM entries WHERE url = ? AND vary_values = ?",
+                (url, values),
+            ).fetchone()
+            if row is None:
+                return None
+            vary, status, headers, response_time, initial_age, lifetime = row[:6]
+            digest, accessed = row[6:]
+
+            path = self.body_path(digest)
+            if not os.path.exists(path):
+                self.db.execute(
+                    "DELETE FROM entries WHERE url = ? AND vary_values = ?",
+                    (url, values),
+                )
+                return None
+
+            now = time.time()
+            if now - accessed > TOUCH_INTERVAL:
+                self.db.execute(
+                    "UPDATE entries SET accessed = ?"
+                    " WHERE url = ? AND vary_values = ?",
+                    (now, url, values),
+                )
+
+        headers = [(k, v) for k, v in json.loads(headers)]
+        return CacheEntry(
+            status,
+            headers,
+            tuple(json.loads(vary)),
+            response_time=response_time,
+            initial_age=initial_age,
+            freshness_lifetime=lifetime,
+            cache_control=parse_cache_control(get_header(headers, "cache-control")),
+            path=path,
+        )
+
+    def store(
+        self,
+        url: str,
+        request_headers: Mapping[str, str],
+        entry: CacheEntry,
+        body: Union[bytes, BodyWriter, None] = None,
+    ) -> Optional[str]:
+        """Store `entry` and return the path of its body file.
+
+        `body` is the content, or a `BodyWriter` it was written to; None
+        only updates the metadata of an entry already stored in `path`.
+        Blocking: called from an executor by the proxies.
+        """
+        if body is None:
+            digest, size = os.path.basename(entry.path), None
+        elif isinstance(body, BodyWriter):
+            body.file.close()
+            digest, size = body.hash.hexdigest(), body.size
+            if size > self.max_entry_bytes:
+                body.discard()
+                return None
+            self._move_in_place(body.path, digest)
+        else:
+            digest, size = hashlib.sha256(body).hexdigest(), len(body)
+            if size > self.max_entry_bytes:
+                return None
+            if not os.path.exists(self.body_path(digest)):
+                writer = self.writer()
+                writer.write(body)
+                writer.file.close()
+                self._move_in_place(writer.path, digest)
+
+        url = normalize_url(url)
+        vary = json.dumps(entry.vary)
+        values = json.dumps(vary_values(entry.vary, request_headers))
+        with self._lock:
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, vary))
+                if size is not None:
+                    db.execute(
+                        "INSERT OR IGNORE INTO bodies VALUES (?, ?)", (digest, size)
+                    )
+                db.execute(
+                    "INSERT OR REPLACE INTO entries VALUES"
+                    " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        url,
+                        values,
+                        vary,
+                        entry.status,
+                        json.dumps(entry.headers),
+                        entry.response_time,
+                        entry.initial_age,
+                        entry.freshness_lifetime,
+                        digest,
+                        time.time(),
+                    ),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self._evict()
+        return self.body_path(digest)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("DELETE FROM urls")
+            self._collect()
+
+    def _move_in_place(self, temp_path: str, digest: str) -> None:
+        path = self.body_path(digest)
+        if os.path.exists(path):
+            os.unlink(temp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def _evict(self) -> None:
+        """Drop the least recently used entries until under `max_bytes`."""
+        while True:
+            (size,) = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM bodies"
+            ).fetchone()
+            if size <= self.max_bytes:
+                return
+            keys, freed = [], 0
+            for url, values, body_size in self.db.execute(
+                "SELECT url, vary_values, size FROM entries"
+                " JOIN bodies USING (digest) ORDER BY accessed"
+            ):
+                keys.append((url, values))
+                freed += body_size
+                if size - freed <= self.max_bytes:
+                    break
+            if not keys:
+                return
+            self.db.executemany(
+                "DELETE FROM entries WHERE url = ? AND vary_values = ?", keys
+            )
+            self._collect()
+
+    def _collect(self) -> None:
+        """Delete the bodies no entry refers to any more."""
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM urls WHERE url NOT IN (SELECT url FROM entries)")
+            digests: List[Tuple[str]] = db.execute(
+                "SELECT digest FROM bodies"
+                " WHERE digest NOT IN (SELECT digest FROM entries)"
+            ).fetchall()
+            db.executemany("DELETE FROM bodies WHERE digest = ?", digests)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        for (digest,) in digests:
+            try:
+                os.unlink(self.body_path(digest))
+            except OSError:
+                pass
+
+    def _remove_orphans(self) -> None:
+        directory = os.path.join(self.directory, "tmp")
+        limit = time.time() - ORPHAN_AGE
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def snapshot(entry: CacheEntry) -> CacheEntry:
+    """Copy of the metadata of `entry`, to store it from another thread."""
+    return replace(entry, headers=list(entry.headers), body=b"")
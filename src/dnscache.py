@@ -0,0 +1,171 @@
+"""
+Shared cache of the upstream host name resolutions.
+
+Every new upstream connection would otherwise call ``getaddrinfo``, in a
+thread, and wait for the system resolver.  Addresses are kept for `TTL`
+seconds and failures for `NEGATIVE_TTL` seconds; names in use are resolved
+again in the background before they expire, so the few hosts making up most
+of the traffic are a dictionary hit.
+
+``getaddrinfo`` does not tell the TTL of the DNS records: the cache uses its
+own, short enough to follow DNS changes reasonably fast.
+"""
+
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+# Seconds addresses are reused
+TTL = 60.0
+
+# Seconds a failed resolution is remembered, so a bad name does not cost a
+# lookup per request
+NEGATIVE_TTL = 5.0
+
+# Names still used after this share of their TTL are resolved again in the
+# background
+REFRESH_AFTER = 0.75
+
+# Names cached at most, least recently used evicted first
+MAX_ENTRIES = 1024
+
+# (family, type, proto, canonname, sockaddr), as returned by getaddrinfo
+AddressInfo = Tuple[int, int, int, str, tuple]
+
+Key = Tuple[str, int, int]
+
+
+@dataclass
+class Resolution:
+    addresses: List[AddressInfo] = field(default_factory=list)
+    error: Optional[OSError] = None
+    resolved: float = 0.0
+
+    def failure(self) -> OSError:
+        # A fresh exception, not to pile up tracebacks on the cached one
+        return type(self.error)(*self.error.args)
+
+
+class Resolver:
+    """TTL-bounded cache in front of ``loop.getaddrinfo``.
+
+    Concurrent lookups of the same name share one ``getaddrinfo`` call.
+    """
+
+    def __init__(
+        self,
+        ttl: float = TTL,
+        negative_ttl: float = NEGATIVE_TTL,
+        max_entries: int = MAX_ENTRIES,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries: "OrderedDict[Key, Resolution]" = OrderedDict()
+        self._pending: Dict[Key, asyncio.Future] = {}
+        self._refreshes: Set[asyncio.Task] = set()
+
+    async def resolve(
+        self, host: str, port: int, family: int = socket.AF_UNSPEC
+    ) -> List[AddressInfo]:
+        """Return the addresses of `host`, or raise the resolution error."""
+        if is_address(host):
+            return await self._getaddrinfo((host, port, family))
+
+        key = (host.lower(), port, family)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None:
+            age = now - entry.resolved
+            if entry.error is not None:
+                if age < self.negative_ttl:
+                    self.hits += 1
+                    raise entry.failure()
+            elif age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                if age >= self.ttl * REFRESH_AFTER and key not in self._pending:
+                    self._refresh(key)
+                return entry.addresses
+
+        self.misses += 1
+        entry = await self._lookup(key)
+        if entry.error is not None:
+            raise entry.failure()
+        return entry.addresses
+
+    async def _lookup(self, key: Key) -> Resolution:
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._resolve(key))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        # A cancelled caller must not cancel the lookup of the others
+        return await asyncio.shield(pending)
+
+    async def _resolve(self, key: Key) -> Resolution:
+        try:
+            entry = Resolution(addresses=await self._getaddrinfo(key))
+        except OSError as e:
+            entry = Resolution(error=e)
+        entry.resolved = time.monotonic()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def _getaddrinfo(self, key: Key) -> List[AddressInfo]:
+        host, port, family = key
+        return await asyncio.get_running_loop().getaddrinfo(
+            host, port, family=family, type=socket.SOCK_STREAM
+        )
+
+    def _refresh(self, key: Key) -> None:
+        """Resolve a name in use again, keeping its addresses meanwhile."""
+        stale = self._entries[key]
+        self.refreshes += 1
+
+        async def refresh() -> None:
+            entry = await self._lookup(key)
+            if entry.error is not None:
+                # Keep serving the known addresses until they expire
+                self._entries[key] = stale
+
+        task = asyncio.ensure_future(refresh())
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+    def clear(self) -> None:
+        """Forget the cached names and cancel the lookups in progress."""
+        for task in list(self._refreshes) + list(self._pending.values()):
+            task.cancel()
+        self._refreshes.clear()
+        self._pending.clear()
+        self._entries.clear()
+
+
+def is_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+resolver = Resolver()
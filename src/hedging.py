@@ -0,0 +1,161 @@
+"""
+Hedged upstream requests, to cut the tail latency of slow upstreams.
+
+When the first attempt at a request has not got its response headers after
+the usual worst latency of its host (`PERCENTILE` of the recent ones), a
+second attempt is sent, and whichever answers first is used while the other
+is cancelled.  With HTTP/1.1 the second attempt cannot share the busy
+connection of the first, so it goes out on another one.
+
+Hedging doubles the requests it applies to: a `HedgeBudget` keeps the hedged
+attempts under `BUDGET` of all requests.  Only idempotent requests may be
+hedged, which the proxies' GETs are.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+# Set to True to hedge the upstream requests of the proxies
+HEDGING = False
+
+# Hedge after this percentile of the recent latencies of the host
+PERCENTILE = 0.95
+
+# Latencies kept per host, and needed before hedging at all
+WINDOW = 200
+MIN_SAMPLES = 20
+
+# Never hedge sooner than this many seconds
+MIN_DELAY = 0.01
+
+# Share of the requests that may be hedged, and hedges allowed in a burst
+BUDGET = 0.05
+BURST = 10.0
+
+T = TypeVar("T")
+
+
+class Latencies:
+    """Recent times to response headers of a host."""
+
+    def __init__(self, window: int = WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, math.ceil(p * len(ordered)) - 1)]
+
+
+class HedgeBudget:
+    """Token bucket earning `share` of a hedge per request."""
+
+    def __init__(self, share: float = BUDGET, burst: float = BURST):
+        self.share = share
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self.refused = 0
+
+    def record_request(self) -> None:
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.share)
+
+    def take(self) -> bool:
+        if self.tokens < 1:
+            self.refused += 1
+            return False
+        self.tokens -= 1
+        self.hedged += 1
+        return True
+
+
+budget = HedgeBudget()
+
+_latencies: Dict[str, Latencies] = {}
+
+# Closing the results of losing attempts
+_discards: Set[asyncio.Task] = set()
+
+
+def hedge_delay(host: str) -> Optional[float]:
+    """Seconds to wait for the first attempt, or None not to hedge yet."""
+    latencies = _latencies.get(host)
+    if latencies is None:
+        return None
+    delay = latencies.percentile(PERCENTILE)
+    return None if delay is None else max(delay, MIN_DELAY)
+
+
+async def race(
+    attempt: Callable[[], Awaitable[T]],
+    host: str,
+    discard: Callable[[T], Awaitable[None]],
+) -> T:
+    """Return the result of `attempt`, hedged with a second one if slow.
+
+    `discard` releases the result of an attempt finishing after the winner.
+    If an attempt fails, the other one still gets its chance; if both fail,
+    the error of the first one is raised.
+    """
+    latencies = _latencies.get(host)
+    if latencies is None:
+        latencies = _latencies[host] = Latencies()
+    budget.record_request()
+    start = time.perf_counter()
+
+    attempts = [asyncio.ensure_future(attempt())]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=hedge_delay(host))
+        if not done and budget.take():
+            attempts.append(asyncio.ensure_future(attempt()))
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = next((task for task in done if task.exception() is None), None)
+    finally:
+        for task in attempts:
+            if task is winner:
+                continue
+            if task.done():
+                discard_result(task, discard)
+            else:
+                task.cancel()
+                task.add_done_callback(lambda task: discard_result(task, discard))
+
+    if winner is None:
+        return attempts[0].result()
+    latencies.add(time.perf_counter() - start)
+    if winner is not attempts[0]:
+        budget.won += 1
+    return winner.result()
+
+
+def discard_result(task: asyncio.Future, discard: Callable[[T], Awaitable[None]]):
+    """Release the result of a losing attempt, if it got one."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    cleanup = asyncio.ensure_future(discard(task.result()))
+    _discards.add(cleanup)
+    cleanup.add_done_callback(_discards.discard)
+
+
+def stats() -> Dict[str, int]:
+    return {
+        "requests": budget.requests,
+        "hedged": budget.hedged,
+        "won": budget.won,
+        "refused": budget.refused,
+    }
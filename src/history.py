@@ -0,0 +1,278 @@
+"""
+Append-only history of the benchmark runs, and comparisons between them.
+
+Each measured run of a cell is appended to `STORE_FILE` as a JSON line, with
+the session it belongs to (one invocation of `benchmarks.main`), the git
+commit of the tree, a fingerprint of the host, the options of the session
+and the configuration of the cell.  Nothing is ever rewritten, so the file
+keeps the history of all the sessions run in a directory.
+
+Two sessions are compared cell by cell, flagging the throughput drops and
+p99 latency rises past a threshold that are beyond the noise of the runs::
+
+    python history.py sessions
+    python history.py compare                       # the last two sessions
+    python history.py compare 20261018T101500-3f2a9c 20261018T143000-b71e04 \\
+        --threshold=0.1
+
+``compare`` exits with status 1 when it finds regressions.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import fire
+
+import stats
+
+STORE_FILE = "history.jsonl"
+
+# Relative throughput drop, or p99 latency rise, flagged as a regression
+THRESHOLD = 0.05
+
+# Configuration fields of a cell identifying it across sessions
+CELL_KEY = (
+    "type",
+    "label",
+    "app",
+    "workers",
+    "upstream_protocol",
+    "client",
+    "rate",
+    "size",
+    "latency",
+    "duration",
+    "warmup",
+    "origin",
+    "upstream",
+)
+
+
+def new_session() -> str:
+    """Name of a new session: its start time, and a random suffix for the
+    sessions started within the same second."""
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def git_commit() -> Optional[str]:
+    """Commit of the tree of this file, with a "+dirty" suffix if modified."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + "+dirty" if status.strip() else commit
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("model name"):
+                    return line.partition(":")[2].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_fingerprint() -> Dict[str, object]:
+    return {
+        "hostname": platform.node(),
+        "cpu_model": cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+class Store:
+    """JSON lines file the runs are appended to."""
+
+    def __init__(self, path: str = STORE_FILE):
+        self.path = path
+
+    def append(self, record: dict) -> None:
+        # A single write per line, flushed at once, so that a crash loses at
+        # most the line being written
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def records(self) -> Iterator[dict]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Truncated by a crash
+                    continue
+
+    def sessions(self) -> Dict[str, List[dict]]:
+        """Records by session, in the order of the file."""
+        sessions: Dict[str, List[dict]] = {}
+        for record in self.records():
+            sessions.setdefault(record["session"], []).append(record)
+        return sessions
+
+
+def cell_key(cell: dict) -> Tuple:
+    # Cells recorded without a field match those where it is empty
+    return tuple(None if cell.get(name) == "" else cell.get(name) for name in CELL_KEY)
+
+
+def describe(cell: dict) -> str:
+    parts = [cell["label"], cell["app"].partition(":")[0], f"w={cell['workers']}"]
+    parts.append(cell["upstream_protocol"])
+    for name in ("size", "latency", "rate"):
+        if cell.get(name) is not None:
+            parts.append(f"{name}={cell[name]}")
+    return " ".join(parts)
+
+
+def summarize_session(records: List[dict]) -> Dict[Tuple, dict]:
+    """Throughput and p99 summaries of the cells of a session, by cell key."""
+    runs: Dict[Tuple, List[dict]] = {}
+    cells: Dict[Tuple, dict] = {}
+    for record in records:
+        if record["results"]["speed"] < 0:
+            continue
+        key = cell_key(record["cell"])
+        runs.setdefault(key, []).append(record["results"])
+        cells[key] = record["cell"]
+    summaries = {}
+    for key, results in runs.items():
+        p99s = [r["p99"] for r in results if r.get("p99") is not None]
+        summaries[key] = {
+            "cell": cells[key],
+            "speed": stats.summarize([r["speed"] for r in results]),
+            "p99": stats.summarize(p99s),
+        }
+    return summaries
+
+
+def change(base: float, new: float) -> float:
+    return (new - base) / base if base else 0.0
+
+
+def verdict(
+    base: stats.Summary, new: stats.Summary, relative: float, threshold: float
+) -> str:
+    """How a `relative` change, worse when positive, from `base` to `new` reads.
+
+    "regression" or "improvement" past the `threshold`, unless the runs are
+    not distinguishable ("noise"), and "" within it.
+    """
+    if abs(relative) <= threshold:
+        return ""
+    if stats.distinguishable(base, new) is False:
+        return "noise"
+    return "regression" if relative > 0 else "improvement"
+
+
+def sessions(store: str = STORE_FILE):
+    """List the sessions of the store."""
+    for session, records in Store(store).sessions().items():
+        first = records[0]
+        cells = len({cell_key(record["cell"]) for record in records})
+        print(
+            f"{session}  {first.get('commit') or '-':<48}  "
+            f"{first['host']['hostname']:<16}  {cells:>4} cells  "
+            f"{len(records):>5} runs"
+        )
+
+
+def compare(
+    base: Optional[str] = None,
+    new: Optional[str] = None,
+    threshold: float = THRESHOLD,
+    store: str = STORE_FILE,
+):
+    """Compare the cells of the `new` session with those of the `base` one.
+
+    Sessions default to the last two of the store.  Throughput drops and p99
+    rises larger than `threshold` (relative) are regressions, unless the runs
+    of the two sessions are not statistically distinguishable.
+    """
+    all_sessions = Store(store).sessions()
+    names = list(all_sessions)
+    if new is None:
+        new = names[-1] if names else None
+    if base is None:
+        earlier = names[: names.index(new)] if new in names else []
+        base = earlier[-1] if earlier else None
+    for name in (base, new):
+        if name not in all_sessions:
+            raise ValueError(f"No such session: {name!r}")
+    base_records, new_records = all_sessions[base], all_sessions[new]
+    if base_records[0]["host"] != new_records[0]["host"]:
+        print("# Warning: the sessions ran on different hosts")
+    print(f"# {base} ({base_records[0].get('commit')})")
+    print(f"#  → {new} ({new_records[0].get('commit')})")
+
+    base_cells = summarize_session(base_records)
+    new_cells = summarize_session(new_records)
+    print(
+        f"{'base req/s':>10} | {'new req/s':>10} | {'change':>7} | "
+        f"{'base p99':>9} | {'new p99':>9} | {'change':>7} | {'verdict':>11} | cell"
+    )
+    regressions = 0
+    for key, new_cell in new_cells.items():
+        base_cell = base_cells.get(key)
+        if base_cell is None:
+            continue
+        base_speed, new_speed = base_cell["speed"], new_cell["speed"]
+        speed_change = change(base_speed.mean, new_speed.mean)
+        verdicts = [verdict(base_speed, new_speed, -speed_change, threshold)]
+        base_p99, new_p99 = base_cell["p99"], new_cell["p99"]
+        if base_p99 and new_p99:
+            p99_change = change(base_p99.mean, new_p99.mean)
+            verdicts.append(verdict(base_p99, new_p99, p99_change, threshold))
+            p99_columns = (
+                f"{base_p99.mean:>9.2f} | {new_p99.mean:>9.2f} | "
+                f"{p99_change:>+7.1%}"
+            )
+        else:
+            p99_columns = f"{'-':>9} | {'-':>9} | {'-':>7}"
+        if "regression" in verdicts:
+            result = "REGRESSION"
+            regressions += 1
+        elif "improvement" in verdicts:
+            result = "improvement"
+        else:
+            result = "noise" if "noise" in verdicts else ""
+        print(
+            f"{base_speed.mean:>10.1f} | {new_speed.mean:>10.1f} | "
+            f"{speed_change:>+7.1%} | {p99_columns} | {result:>11} | "
+            f"{describe(new_cell['cell'])}"
+        )
+
+    missing = set(base_cells) - set(new_cells)
+    if missing:
+        print(f"# {len(missing)} cells of {base} missing from {new}")
+    print(f"# Regressions past {threshold:.0%}: {regressions}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire({"sessions": sessions, "compare": compare})
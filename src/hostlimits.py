@@ -0,0 +1,189 @@
+"""
+Per-upstream-host concurrency limits, with bounded waiting and load shedding.
+
+Each upstream host gets a gate letting at most `HostLimits.max_concurrency`
+requests through at a time.  Requests beyond that wait in a FIFO queue of at
+most `max_queue` requests, for at most `max_queue_wait` seconds; requests
+that find the queue full, or that wait too long, are shed at once with
+`Overloaded` (a ``503`` downstream).  A slow or dead upstream thus only ties
+up its own share of the worker instead of every coroutine or thread.
+
+Limits apply to all hosts unless overridden, e.g.::
+
+    hostlimits.overrides["slow.example.com"] = HostLimits(max_concurrency=4)
+"""
+
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict
+from urllib.parse import urlsplit
+
+# Sent with a shed request's 503
+RETRY_AFTER = 1
+
+
+@dataclass
+class HostLimits:
+    # Requests to the host in flight at the same time
+    max_concurrency: int = 20
+    # Requests waiting for their turn; more are shed
+    max_queue: int = 100
+    # Seconds a request may wait for its turn before it is shed
+    max_queue_wait: float = 2.0
+
+
+defaults = HostLimits()
+
+# By host name, or by host name and port
+overrides: Dict[str, HostLimits] = {}
+
+_gates: Dict[str, "HostGate"] = {}
+_thread_gates: Dict[str, "ThreadHostGate"] = {}
+_thread_gates_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    """The upstream host has too many requests in flight and waiting."""
+
+
+def get_limits(host: str) -> HostLimits:
+    limits = overrides.get(host)
+    if limits is None:
+        limits = overrides.get(host.rpartition(":")[0] or host, defaults)
+    return limits
+
+
+def get_host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+class HostGate:
+    """Concurrency gate of one host, for coroutines."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.active = 0
+        self.shed = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def limits(self) -> HostLimits:
+        return get_limits(self.host)
+
+    async def acquire(self) -> None:
+        limits = self.limits
+        if self.active < limits.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= limits.max_queue:
+            self.shed += 1
+            raise Overloaded(self.host)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), limits.max_queue_wait)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            self.shed += 1
+            raise Overloaded(self.host) from None
+        except BaseException:
+            if waiter.done():
+                # Our turn came as we were cancelled: pass it on
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+
+    def release(self) -> None:
+        """Hand the slot over to the first waiter, if any."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class ThreadHostGate:
+    """Concurrency gate of one host, for the threads of the WSGI proxies."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.active = 0
+        self.shed = 0
+        self._waiters: Deque[threading.Event] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def limits(self) -> HostLimits:
+        return get_limits(self.host)
+
+    def acquire(self) -> None:
+        limits = self.limits
+        with self._lock:
+            if self.active < limits.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+            if len(self._waiters) >= limits.max_queue:
+                self.shed += 1
+                raise Overloaded(self.host)
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        if waiter.wait(limits.max_queue_wait):
+            return
+        with self._lock:
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+            self.shed += 1
+        raise Overloaded(self.host)
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+
+def gate(url: str) -> HostGate:
+    host = get_host(url)
+    host_gate = _gates.get(host)
+    if host_gate is None:
+        host_gate = _gates[host] = HostGate(host)
+    return host_gate
+
+
+def thread_gate(url: str) -> ThreadHostGate:
+    host = get_host(url)
+    with _thread_gates_lock:
+        host_gate = _thread_gates.get(host)
+        if host_gate is None:
+            host_gate = _thread_gates[host] = ThreadHostGate(host)
+    return host_gate
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Requests in flight, waiting and shed so far, by host."""
+    result = {}
+    for host_gate in list(_gates.values()) + list(_thread_gates.values()):
+        host_stats = result.setdefault(
+            host_gate.host, {"active": 0, "waiting": 0, "shed": 0}
+        )
+        host_stats["active"] += host_gate.active
+        host_stats["waiting"] += len(host_gate._waiters)
+        host_stats["shed"] += host_gate.shed
+    return result
+
+
+def reset() -> None:
+    """Forget the gates of the coroutines, bound to the closing event loop."""
+    _gates.clear()
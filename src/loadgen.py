@@ -0,0 +1,205 @@
+"""
+HTTP load generator for the benchmarks, in place of wrk.
+
+Two modes:
+
+- closed loop (the default): `connections` clients each send a request as
+  soon as they got the answer to the previous one, like wrk does;
+- open loop, with `rate`: requests are sent at a constant rate, whether the
+  server keeps up or not, and their latency is counted from the time they
+  were due to be sent.  A closed-loop client waiting for a stalled server
+  sends fewer requests, so the stall only shows in a few latencies
+  ("coordinated omission"); an open-loop one shows it in all the requests
+  that should have been sent meanwhile.
+
+The load is spread over `processes` processes, each running an event loop.
+The report has the format of the wrk script of `benchmarks`, e.g.::
+
+    python loadgen.py --url=http://localhost:8000/ --duration=30 --rate=2000
+"""
+
+import asyncio
+import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import aiohttp
+import fire
+
+# Seconds before a request counts as timed out
+TIMEOUT = 10.0
+
+PERCENTILES = {"p50": 50, "p90": 90, "p99": 99, "p999": 99.9}
+
+
+@dataclass
+class Tally:
+    # Seconds from the (intended) sending time to the end of each response
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    timeouts: int = 0
+    bytes: int = 0
+    # Seconds from the first request to the last response
+    elapsed: float = 0.0
+
+    def add(self, other: "Tally") -> None:
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.timeouts += other.timeouts
+        self.bytes += other.bytes
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+
+async def fetch(
+    session: aiohttp.ClientSession, url: str, started: float, tally: Tally
+) -> None:
+    """GET `url`, counting its latency from `started`, in loop time."""
+    try:
+        async with session.get(url) as response:
+            body = await response.read()
+    except asyncio.TimeoutError:
+        tally.timeouts += 1
+        return
+    except aiohttp.ClientError:
+        tally.errors += 1
+        return
+    tally.latencies.append(asyncio.get_running_loop().time() - started)
+    tally.bytes += len(body)
+    # As wrk, which counts the answers other than 2xx and 3xx as errors
+    if response.status >= 400:
+        tally.errors += 1
+
+
+async def closed_loop(
+    session: aiohttp.ClientSession, url: str, duration: float, connections: int
+) -> Tally:
+    loop = asyncio.get_running_loop()
+    tally = Tally()
+    start = loop.time()
+    end = start + duration
+
+    async def client() -> None:
+        while loop.time() < end:
+            await fetch(session, url, loop.time(), tally)
+
+    await asyncio.gather(*(client() for _ in range(connections)))
+    tally.elapsed = loop.time() - start
+    return tally
+
+
+async def open_loop(
+    session: aiohttp.ClientSession, url: str, duration: float, rate: float
+) -> Tally:
+    """Send `rate` requests per second, however long they take.
+
+    Requests due while all the connections are busy wait for one, and that
+    wait counts in their latency.
+    """
+    loop = asyncio.get_running_loop()
+    tally = Tally()
+    start = loop.time()
+    pending = set()
+    for i in range(int(duration * rate)):
+        due = start + i / rate
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Late requests are sent at once, their latency counting from `due`
+        task = asyncio.ensure_future(fetch(session, url, due, tally))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+    tally.elapsed = loop.time() - start
+    return tally
+
+
+async def generate(
+    url: str,
+    duration: float,
+    connections: int,
+    rate: Optional[float],
+    timeout: float,
+) -> Tally:
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        if rate:
+            return await open_loop(session, url, duration, rate)
+        return await closed_loop(session, url, duration, connections)
+
+
+def run_process(
+    url: str,
+    duration: float,
+    connections: int,
+    rate: Optional[float],
+    timeout: float,
+) -> Tally:
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+    return asyncio.run(generate(url, duration, connections, rate, timeout))
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def report(tally: Tally) -> str:
+    """Results in the format of the benchmarks' wrk script, in microseconds."""
+    ordered = sorted(tally.latencies)
+    elapsed = tally.elapsed or 1.0
+    lines = [f"Requests/sec: {len(ordered) / elapsed:.2f}"]
+    for name, p in PERCENTILES.items():
+        lines.append(f"latency_{name}: {percentile(ordered, p) * 1e6:.0f}")
+    lines.append(f"latency_max: {(ordered[-1] if ordered else 0) * 1e6:.0f}")
+    lines.append(f"errors: {tally.errors}")
+    lines.append(f"timeouts: {tally.timeouts}")
+    lines.append(f"bytes: {tally.bytes}")
+    lines.append(f"duration: {elapsed * 1e6:.0f}")
+    return "\n".join(lines)
+
+
+def main(
+    url: str,
+    duration: float = 30,
+    connections: int = 10,
+    processes: int = 1,
+    rate: Optional[float] = None,
+    timeout: float = TIMEOUT,
+):
+    """Load `url` for `duration` seconds, at `rate` requests per second if
+    given, and print the results.
+
+    `connections` and `rate` are totals, shared by the `processes`.
+    """
+    connections_per_process = max(1, connections // processes)
+    rate_per_process = rate / processes if rate else None
+    tally = Tally()
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [
+            executor.submit(
+                run_process,
+                url,
+                duration,
+                connections_per_process,
+                rate_per_process,
+                timeout,
+            )
+            for _ in range(processes)
+        ]
+        for future in futures:
+            tally.add(future.result())
+    print(report(tally))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
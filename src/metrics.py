@@ -0,0 +1,456 @@
+"""
+Low-overhead metrics of the ASGI proxies, in the Prometheus text format.
+
+Each worker records into counters and histograms of its own, without locks:
+a worker runs a single event loop, on which recording a request is a few
+list and dictionary updates.  Every `FLUSH_INTERVAL` seconds, a worker
+writes a snapshot of its metrics to a file of `DIRECTORY`, shared by the
+workers of a server, and ``/metrics`` (see `MetricsMiddleware`) adds up the
+snapshots of all the live workers, so any worker can answer a scrape.
+Servers running side by side on a host each need their own directory, set
+with ``MINIJ_METRICS_DIR``.
+
+Latencies go to HDR-style histograms: `SUB_BUCKETS` linear buckets per power
+of two from `MIN_SECONDS`, so that a latency is known within the same share
+of its value, whatever its magnitude.
+
+The counters of a worker that exited leave the sums, which Prometheus takes
+for a counter reset.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import breaker
+import contentcoding
+import dnscache
+import hedging
+import hostlimits
+
+PATH = "/metrics"
+
+DIRECTORY = os.environ.get("MINIJ_METRICS_DIR") or os.path.join(
+    tempfile.gettempdir(), "minij-proxy-metrics"
+)
+
+# Seconds between two snapshots of a worker
+FLUSH_INTERVAL = 1.0
+
+# Upper bounds of the latency buckets: `SUB_BUCKETS` per power of two, from
+# `MIN_SECONDS` to about 3 minutes, above which latencies are only counted
+MIN_SECONDS = 0.0001
+SUB_BUCKETS = 4
+OCTAVES = 21
+BOUNDS = tuple(
+    MIN_SECONDS * 2**octave * (1 + step / SUB_BUCKETS)
+    for octave in range(OCTAVES)
+    for step in range(SUB_BUCKETS)
+)
+_LE = [f"{bound:.6g}" for bound in BOUNDS] + ["+Inf"]
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# Type and help of the exposed metrics, in their order of exposition
+FAMILIES: Dict[str, Tuple[str, str]] = {
+    "minij_requests_total": ("counter", "Requests answered, by status."),
+    "minij_request_duration_seconds": (
+        "histogram",
+        "Time to answer a request, body included.",
+    ),
+    "minij_requests_in_flight": ("gauge", "Requests being answered."),
+    "minij_sent_bytes_total": ("counter", "Body bytes sent to the clients."),
+    "minij_received_bytes_total": (
+        "counter",
+        "Body bytes received from the upstreams.",
+    ),
+    "minij_upstream_connect_seconds": (
+        "histogram",
+        "Time to resolve, connect to and negotiate TLS with an upstream.",
+    ),
+    "minij_upstream_first_byte_seconds": (
+        "histogram",
+        "Time to the response headers of an upstream, connecting included.",
+    ),
+    "minij_upstream_body_seconds": (
+        "histogram",
+        "Time to read the body of an upstream response.",
+    ),
+    "minij_upstream_body_errors_total": (
+        "counter",
+        "Upstream bodies cut short once the response had started, by cause.",
+    ),
+    "minij_upstream_active_requests": (
+        "gauge",
+        "Requests in flight to an upstream host.",
+    ),
+    "minij_upstream_waiting_requests": (
+        "gauge",
+        "Requests waiting for their turn to go to an upstream host.",
+    ),
+    "minij_upstream_max_concurrency": (
+        "gauge",
+        "Requests allowed in flight to an upstream host.",
+    ),
+    "minij_upstream_shed_total": (
+        "counter",
+        "Requests to an upstream host shed with a 503.",
+    ),
+    "minij_upstream_connections": (
+        "gauge",
+        "Connections of the upstream pool, by state.",
+    ),
+    "minij_upstream_max_connections": (
+        "gauge",
+        "Connections allowed in the upstream pool.",
+    ),
+    "minij_circuit_open": ("gauge", "1 if the circuit of a host is not closed."),
+    "minij_circuit_rejected_total": (
+        "counter",
+        "Requests failed fast by the circuit of a host.",
+    ),
+    "minij_circuit_trips_total": ("counter", "Times the circuit of a host opened."),
+    "minij_dns_cache_entries": ("gauge", "Host names in the DNS cache."),
+    "minij_dns_cache_lookups_total": (
+        "counter",
+        "Host name lookups, by result in the DNS cache.",
+    ),
+    "minij_dns_cache_refreshes_total": (
+        "counter",
+        "Host names resolved again in the background.",
+    ),
+    "minij_hedging_requests_total": ("counter", "Requests eligible for hedging."),
+    "minij_hedges_total": ("counter", "Hedged attempts, by outcome."),
+    "minij_flights_in_flight": ("gauge", "Shared upstream fetches in progress."),
+    "minij_flights_started_total": ("counter", "Shared upstream fetches started."),
+    "minij_flights_collapsed_total": (
+        "counter",
+        "Requests served by a shared fetch instead of starting one.",
+    ),
+    "minij_flights_timeouts_total": (
+        "counter",
+        "Requests that gave up waiting for a shared fetch.",
+    ),
+    "minij_compression_cpu_seconds_total": (
+        "counter",
+        "CPU time spent compressing responses.",
+    ),
+    "minij_compression_refused_total": (
+        "counter",
+        "Responses left or sent partly uncompressed for lack of CPU budget.",
+    ),
+}
+
+# (family, labels, value), with labels already formatted
+Sample = Tuple[str, str, float]
+
+
+class Histogram:
+    """Counts of the values up to each of `BOUNDS`, and above them all."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.sum += seconds
+
+
+request_duration = Histogram()
+upstream_connect = Histogram()
+upstream_first_byte = Histogram()
+upstream_body = Histogram()
+
+histograms = {
+    "minij_request_duration_seconds": request_duration,
+    "minij_upstream_connect_seconds": upstream_connect,
+    "minij_upstream_first_byte_seconds": upstream_first_byte,
+    "minij_upstream_body_seconds": upstream_body,
+}
+
+# Requests answered, by status
+statuses: Dict[int, int] = {}
+
+# Responses of which the upstream body failed after the headers, by cause
+body_errors: Dict[str, int] = {}
+
+in_flight = 0
+sent_bytes = 0
+received_bytes = 0
+
+# Functions returning samples of the state kept by other modules, called for
+# each snapshot
+collectors: List[Callable[[], Iterable[Sample]]] = []
+
+_next_flush = 0.0
+_flush_scheduled = False
+
+
+def observe_request(status: int, seconds: float, sent: int) -> None:
+    global sent_bytes
+    statuses[status] = statuses.get(status, 0) + 1
+    request_duration.observe(seconds)
+    sent_bytes += sent
+
+
+def add_received(count: int) -> None:
+    global received_bytes
+    received_bytes += count
+
+
+def add_body_error(cause: str) -> None:
+    body_errors[cause] = body_errors.get(cause, 0) + 1
+
+
+def label(name: str, value: str) -> str:
+    value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+
+def snapshot() -> dict:
+    """Metrics of this worker, as written to its file."""
+    samples: List[Sample] = [
+        ("minij_requests_total", label("status", str(status)), count)
+        for status, count in statuses.items()
+    ]
+    samples += [
+        ("minij_requests_in_flight", "", in_flight),
+        ("minij_sent_bytes_total", "", sent_bytes),
+        ("minij_received_bytes_total", "", received_bytes),
+    ]
+    samples += [
+        ("minij_upstream_body_errors_total", label("cause", cause), count)
+        for cause, count in body_errors.items()
+    ]
+    for collector in collectors:
+        samples.extend(collector())
+    return {
+        "samples": samples,
+        "histograms": {
+            name: [histogram.counts, histogram.sum]
+            for name, histogram in histograms.items()
+        },
+    }
+
+
+def collect_stats() -> Iterable[Sample]:
+    """Samples of the stats of the shared upstream machinery."""
+    for host, host_stats in hostlimits.stats().items():
+        host_label = label("host", host)
+        yield "minij_upstream_active_requests", host_label, host_stats["active"]
+        yield "minij_upstream_waiting_requests", host_label, host_stats["waiting"]
+        yield "minij_upstream_shed_total", host_label, host_stats["shed"]
+        yield (
+            "minij_upstream_max_concurrency",
+            host_label,
+            hostlimits.get_limits(host).max_concurrency,
+        )
+    for host, circuit_stats in breaker.stats().items():
+        host_label = label("host", host)
+        is_open = circuit_stats["state"] != breaker.CLOSED
+        yield "minij_circuit_open", host_label, int(is_open)
+        yield "minij_circuit_rejected_total", host_label, circuit_stats["rejected"]
+        yield "minij_circuit_trips_total", host_label, circuit_stats["trips"]
+
+    dns_stats = dnscache.resolver.stats()
+    yield "minij_dns_cache_entries", "", dns_stats["entries"]
+    yield "minij_dns_cache_lookups_total", label("result", "hit"), dns_stats["hits"]
+    yield "minij_dns_cache_lookups_total", label("result", "miss"), dns_stats["misses"]
+    yield "minij_dns_cache_refreshes_total", "", dns_stats["refreshes"]
+
+    hedging_stats = hedging.stats()
+    yield "minij_hedging_requests_total", "", hedging_stats["requests"]
+    for outcome in ("hedged", "won", "refused"):
+        yield "minij_hedges_total", label("outcome", outcome), hedging_stats[outcome]
+
+    yield "minij_compression_cpu_seconds_total", "", contentcoding.budget.spent
+    yield "minij_compression_refused_total", "", contentcoding.budget.refused
+
+
+collectors.append(collect_stats)
+
+
+def flush() -> None:
+    """Write the snapshot of this worker, for the others to read."""
+    global _next_flush, _flush_scheduled
+    _next_flush = time.monotonic() + FLUSH_INTERVAL
+    _flush_scheduled = False
+    path = os.path.join(DIRECTORY, f"{os.getpid()}.json")
+    try:
+        os.makedirs(DIRECTORY, exist_ok=True)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(snapshot(), file)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        # Metrics must not break the proxy
+        pass
+
+
+def schedule_flush() -> None:
+    """Flush once `FLUSH_INTERVAL` has passed since the last flush.
+
+    The flush runs from the event loop, so that the last requests before a
+    worker goes idle are not left out of its file.
+    """
+    global _flush_scheduled
+    if _flush_scheduled:
+        return
+    _flush_scheduled = True
+    delay = max(0.0, _next_flush - time.monotonic())
+    asyncio.get_running_loop().call_later(delay, flush)
+
+
+def worker_snapshots() -> Iterable[dict]:
+    """Snapshots of this worker and of the other live ones.
+
+    The files of dead workers are removed on the way.
+    """
+    yield snapshot()
+    try:
+        names = os.listdir(DIRECTORY)
+    except OSError:
+        return
+    for name in names:
+        pid, _, extension = name.partition(".")
+        if extension != "json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        path = os.path.join(DIRECTORY, name)
+        if not is_alive(int(pid)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as file:
+                yield json.load(file)
+        except (OSError, ValueError):
+            continue
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render() -> str:
+    """Sum of the metrics of the live workers, in the Prometheus text format."""
+    flush()
+    samples: Dict[str, Dict[str, float]] = {}
+    histogram_totals: Dict[str, List] = {}
+    for worker in worker_snapshots():
+        for family, labels, value in worker["samples"]:
+            family_samples = samples.setdefault(family, {})
+            family_samples[labels] = family_samples.get(labels, 0) + value
+        for name, (counts, total) in worker["histograms"].items():
+            if len(counts) != len(_LE):
+                # Written with other buckets, by another version
+                continue
+            if name not in histogram_totals:
+                histogram_totals[name] = [list(counts), total]
+                continue
+            totals = histogram_totals[name]
+            totals[0] = [a + b for a, b in zip(totals[0], counts)]
+            totals[1] += total
+
+    lines = []
+    for family, (kind, description) in FAMILIES.items():
+        if kind == "histogram":
+            if family not in histogram_totals:
+                continue
+            lines += [f"# HELP {family} {description}", f"# TYPE {family} {kind}"]
+            counts, total = histogram_totals[family]
+            cumulative = 0
+            for le, count in zip(_LE, counts):
+                cumulative += count
+                lines.append(f'{family}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{family}_sum {total}")
+            lines.append(f"{family}_count {cumulative}")
+            continue
+        family_samples = samples.get(family)
+        if not family_samples:
+            continue
+        lines += [f"# HELP {family} {description}", f"# TYPE {family} {kind}"]
+        for labels, value in sorted(family_samples.items()):
+            if labels:
+                lines.append(f"{family}{{{labels}}} {value}")
+            else:
+                lines.append(f"{family} {value}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+async def send_metrics(send) -> None:
+    body = render().encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", CONTENT_TYPE),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def file_message_size(message: dict) -> int:
+    """Bytes sent by a ``pathsend`` or ``zerocopy`` ASGI message."""
+    if "path" in message:
+        return os.path.getsize(message["path"])
+    count = message.get("count")
+    if count is not None:
+        return count
+    size = os.fstat(message["file"].fileno()).st_size
+    return size - message.get("offset", 0)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the HTTP requests, and answering `PATH`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"] == PATH:
+            await send_metrics(send)
+            return
+
+        start = time.perf_counter()
+        # The server answers 500 for an application failing before the start
+        status = 500
+        sent = 0
+
+        async def send_recorded(message) -> None:
+            nonlocal status, sent
+            kind = message["type"]
+            if kind == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif kind == "http.response.start":
+                status = message["status"]
+            elif kind in ("http.response.pathsend", "http.response.zerocopy"):
+                sent += file_message_size(message)
+            await send(message)
+
+        in_flight += 1
+        try:
+            await self.app(scope, receive, send_recorded)
+        finally:
+            in_flight -= 1
+            observe_request(status, time.perf_counter() - start, sent)
+            schedule_flush()
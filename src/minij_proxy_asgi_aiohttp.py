@@ -1,4 +1,5 @@
 import asyncio
+import time
 from typing import Mapping
 
 import aiohttp
@@ -6,57 +7,129 @@ import fire
 import uvicorn
 from aiohttp import ClientSSLError, ClientTimeout, TooManyRedirects
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
-# Extremely aggressive and hardcoded value
-TIMEOUT = 10
+import breaker
+import hostlimits
+import metrics
+import streaming
+import timeouts
+import tracing
+import upstream
 
 DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
 
 
-async def application(scope, receive, send):
+async def proxy_application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await upstream.handle_lifespan(scope, receive, send)
+        return
     if scope["type"] != "http":
         return
 
     request = Request(scope, receive)
-    response = Response()
-
     if request.method != "GET":
-        response.status = 405
+        response = Response(status_code=405)
     else:
-        async with aiohttp.ClientSession() as client:
-            await fetch_content(client, request, response)
+        client = upstream.get_aiohttp_session()
+        response = await fetch_content(client, request)
 
     await response(scope, receive, send)
 
 
-async def fetch_content(
-    client: aiohttp.ClientSession, request: Request, response: Response
-) -> None:
+application = metrics.MetricsMiddleware(tracing.TracingMiddleware(proxy_application))
+
+
+async def fetch_content(client: aiohttp.ClientSession, request: Request) -> Response:
+    """Fetch the ``url`` of `request`, streaming the body through unless
+    `streaming.STREAMING` is off, in which case it is read first."""
     url = request.query_params["url"]
     proxy_query_header = make_request_headers(request.headers)
 
+    deadline = timeouts.client_deadline(request.headers)
+    limits = timeouts.get_timeouts(hostlimits.get_host(url))
+    circuit = breaker.get(url)
+    slot = hostlimits.gate(url)
     try:
-        proxy_response = await client.get(
-            url, headers=proxy_query_header, timeout=TIMEOUT
+        timeouts.check(deadline)
+        circuit.check()
+        try:
+            await slot.acquire()
+        except BaseException:
+            circuit.abandon()
+            raise
+        tracing.mark("slot")
+        try:
+            limits = limits.capped(deadline)
+            start = time.perf_counter()
+            proxy_response = await asyncio.wait_for(
+                client.get(
+                    url,
+                    headers=proxy_query_header,
+                    timeout=aiohttp_timeout(limits),
+                ),
+                limits.first_byte,
+            )
+            tracing.mark("headers")
+            metrics.upstream_first_byte.observe(time.perf_counter() - start)
+            if not streaming.STREAMING:
+                # Within the total timeout, and failing like the headers
+                body = await proxy_response.read()
+        except BaseException:
+            slot.release()
+            circuit.abandon()
+            raise
+    except timeouts.DeadlineExceeded:
+        response = Response(status_code=524)
+    except breaker.CircuitOpen as e:
+        response = Response(
+            status_code=e.status, headers={"Retry-After": str(e.retry_after)}
+        )
+    except hostlimits.Overloaded:
+        response = Response(
+            status_code=503, headers={"Retry-After": str(hostlimits.RETRY_AFTER)}
         )
     except ClientSSLError:
         # Invalid SSL Certificate
-        status = 526
-    except ConnectionError:
-        status = 523
-    except ClientTimeout:
-        status = 524
+        response = Response(status_code=526)
+        circuit.record(526)
+    except asyncio.TimeoutError:
+        response = Response(status_code=524)
+        if not timeouts.expired(deadline):
+            circuit.record(524)
     except TooManyRedirects:
-        status = 520
+        response = Response(status_code=520)
+        circuit.record(520)
+    except aiohttp.ClientError:
+        response = Response(status_code=523)
+        circuit.record(523)
     else:
-        response.body = await proxy_response.content.read()
+        circuit.record(proxy_response.status)
+        if streaming.STREAMING:
+            response = StreamingResponse(
+                streaming.iter_aiohttp(proxy_response, release=slot.release),
+                status_code=proxy_response.status,
+            )
+        else:
+            slot.release()
+            metrics.add_received(len(body))
+            response = Response(body, status_code=proxy_response.status)
         if proxy_response.status == 500:
-            response.status = 520
+            response.status_code = 520
         else:
             copy_proxy_headers(proxy_response, response)
 
     response.headers["Access-Control-Allow-Origin"] = get_access_url(request.headers)
+    return response
+
+
+def aiohttp_timeout(limits: timeouts.Timeouts) -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(
+        total=limits.total,
+        connect=limits.pool + limits.connect + limits.tls,
+        sock_connect=limits.connect + limits.tls,
+        sock_read=limits.read,
+    )
 
 
 def make_request_headers(headers: Mapping):
@@ -66,6 +139,7 @@ def make_request_headers(headers: Mapping):
         "Accept",
         "Accept-Language",
         "Range",
+        "If-Range",
         "If-Modified-Since",
         "If-None-Match",
     ]
@@ -1,106 +1,45 @@
 import asyncio
-from typing import Mapping
 
 import fire
-import httpx
-import requests
 import uvicorn
 from starlette.requests import Request
 from starlette.responses import Response
 
-# Extremely aggressive and hardcoded value
-TIMEOUT = 10
+import metrics
+import proxy
+import tracing
+import upstream
 
-DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
 
-
-async def application(scope, receive, send):
+async def proxy_application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await upstream.handle_lifespan(scope, receive, send)
+        return
     if scope["type"] != "http":
         return
 
     request = Request(scope, receive)
-    response = Response()
 
     if request.method != "GET":
-        response.status = 405
+        response = Response(status_code=405)
     else:
-        async with httpx.AsyncClient() as client:
-            await fetch_content(client, request, response)
+        response = await fetch_content(request)
 
     await response(scope, receive, send)
 
 
-async def fetch_content(client, request: Request, response: Response) -> None:
-    url = request.query_params["url"]
-    proxy_query_header = make_request_headers(request.headers)
+application = metrics.MetricsMiddleware(tracing.TracingMiddleware(proxy_application))
 
-    try:
-        proxy_response = await client.get(
-            url, headers=proxy_query_header, timeout=TIMEOUT
-        )
-    except requests.exceptions.SSLError:
-        # Invalid SSL Certificate
-        response.status = 526
-    except requests.exceptions.ConnectionError:
-        response.status = 523
-    except requests.exceptions.Timeout:
-        response.status = 524
-    except requests.exceptions.TooManyRedirects:
-        response.status = 520
-    else:
-        response.body = proxy_response.content
-        if proxy_response.status_code == 500:
-            response.status = 520
-        else:
-            copy_proxy_headers(proxy_response, response)
-
-    response.headers["Access-Control-Allow-Origin"] = get_access_url(request.headers)
-
-
-def make_request_headers(headers: Mapping):
-    request_headers = {}
-    HEADERS = [
-        "Content-Type",
-        "Accept",
-        "Accept-Language",
-        "Range",
-        "If-Modified-Since",
-        "If-None-Match",
-    ]
-    for k in HEADERS:
-        v = headers.get(k)
-        if v:
-            request_headers[k] = str(v)
-
-    return request_headers
-
-
-def get_access_url(headers: Mapping):
-    return headers.get("Origin", DEFAULT_ACCESS_URL)
-
-
-def copy_proxy_headers(proxy_response, response) -> None:
-    HEADERS = [
-        "Content-Disposition",
-        "Content-Type",
-        "Date",
-        "Last-Modified",
-        "Vary",
-        "Cache-Control",
-        "Etag",
-        "Accept-Ranges",
-        "Content-Range",
-    ]
-    for k, v in proxy_response.headers.items():
-        k = k.title()
-        if k in HEADERS:
-            response.headers[k] = v
+
+async def fetch_content(request: Request) -> proxy.ProxyResponse:
+    url = request.query_params["url"]
+    return await proxy.fetch(url, request.headers)
 
 
 def main(host="localhost", port=8000, server="uvicorn"):
     if server == "uvicorn":
         uvicorn.run(
-            "minij_proxy_asgi:application", host=host, port=port, log_level="info"
+            "minij_proxy_asgi_httpx:application", host=host, port=port, log_level="info"
         )
 
     elif server == "hypercorn":
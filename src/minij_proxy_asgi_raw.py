@@ -0,0 +1,98 @@
+"""
+Framework-free variant of `minij_proxy_asgi_httpx`.
+
+The query string and the request headers are read straight from the ASGI
+scope, as bytes: only the ``url`` parameter and the headers the proxy uses
+are decoded, and no framework request or response object is built.
+"""
+
+import asyncio
+from typing import Dict, Optional
+from urllib.parse import unquote_plus
+
+import fire
+import uvicorn
+
+import metrics
+import proxy
+import tracing
+import upstream
+
+CLIENT_HEADERS = frozenset(name.encode("latin-1") for name in proxy.CLIENT_HEADERS)
+
+METHOD_NOT_ALLOWED = {
+    "type": "http.response.start",
+    "status": 405,
+    "headers": [(b"content-length", b"0"), (b"allow", b"GET")],
+}
+
+BAD_REQUEST = {
+    "type": "http.response.start",
+    "status": 400,
+    "headers": [(b"content-length", b"0")],
+}
+
+EMPTY_BODY = {"type": "http.response.body", "body": b""}
+
+
+async def proxy_application(scope, receive, send):
+    if scope["type"] != "http":
+        if scope["type"] == "lifespan":
+            await upstream.handle_lifespan(scope, receive, send)
+        return
+
+    if scope["method"] != "GET":
+        await send(METHOD_NOT_ALLOWED)
+        await send(EMPTY_BODY)
+        return
+
+    url = get_url(scope["query_string"])
+    if url is None:
+        await send(BAD_REQUEST)
+        await send(EMPTY_BODY)
+        return
+
+    response = await proxy.fetch(url, get_headers(scope["headers"]))
+    await response(scope, receive, send)
+
+
+application = metrics.MetricsMiddleware(tracing.TracingMiddleware(proxy_application))
+
+
+def get_url(query_string: bytes) -> Optional[str]:
+    for param in query_string.split(b"&"):
+        if param.startswith(b"url="):
+            return unquote_plus(param[4:].decode("latin-1"))
+    return None
+
+
+def get_headers(raw_headers) -> Dict[str, str]:
+    """Decode the headers used by the proxy; ASGI names are lower-case."""
+    headers = {}
+    for k, v in raw_headers:
+        if k in CLIENT_HEADERS:
+            name = k.decode("latin-1")
+            value = v.decode("latin-1")
+            if name in headers:
+                value = f"{headers[name]}, {value}"
+            headers[name] = value
+    return headers
+
+
+def main(host="localhost", port=8000, server="uvicorn"):
+    if server == "uvicorn":
+        uvicorn.run(
+            "minij_proxy_asgi_raw:application", host=host, port=port, log_level="info"
+        )
+
+    elif server == "hypercorn":
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"{host}:{port}"]
+        asyncio.run(serve(application, config))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,100 +1,62 @@
 import asyncio
-from typing import Mapping
 
 import blacksheep
 import fire
-import httpx
-import requests
 import uvicorn
-from blacksheep import Content, Headers, Request, Response
+from blacksheep import Content, Request, StreamedContent
 from blacksheep.server import Application
 
-# Extremely aggressive and hardcoded value
-from devtools import debug
+import metrics
+import proxy
+import streaming
+import tracing
+import upstream
 
-TIMEOUT = 10
+proxy_app = Application()
 
-DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
 
-app = Application()
+async def on_start(application: Application) -> None:
+    await upstream.startup()
 
 
-@app.router.get("/")
-async def home(url: str, request: Request):
-    headers = request.headers
-    proxy_query_header = make_request_headers(headers)
-
-    try:
-        async with httpx.AsyncClient() as client:
-            proxy_response = await client.get(
-                url, headers=proxy_query_header, timeout=TIMEOUT
-            )
-
-    except requests.exceptions.SSLError:
-        # Invalid SSL Certificate
-        status = 526
-    except requests.exceptions.ConnectionError:
-        status = 523
-    except requests.exceptions.Timeout:
-        status = 524
-    except requests.exceptions.TooManyRedirects:
-        status = 520
-    else:
-        body = proxy_response.content
-        if proxy_response.status_code == 500:
-            status = 520
-        else:
-            status = 200
-
-    headers = []
-    if status == 200:
-        # copy_proxy_headers(proxy_response, response)
-        headers += [(b"Access-Control-Allow-Origin", get_access_url(headers))]
-
-    response = blacksheep.Response(
-        status, content=Content(b"text/html", body), headers=headers
-    )
-    return response
-
-
-def make_request_headers(headers: Headers):
-    request_headers = {}
-    HEADERS = [
-        "Content-Type",
-        "Accept",
-        "Accept-Language",
-        "Range",
-        "If-Modified-Since",
-        "If-None-Match",
-    ]
-    for k in HEADERS:
-        v = headers.get(k.encode("ascii"))
-        if v:
-            request_headers[k] = str(v)
+async def on_stop(application: Application) -> None:
+    await upstream.shutdown()
+
+
+proxy_app.on_start += on_start
+proxy_app.on_stop += on_stop
 
-    return request_headers
 
+@proxy_app.router.get("/")
+async def home(url: str, request: Request):
+    headers = {
+        k.decode("latin-1").lower(): v.decode("latin-1") for k, v in request.headers
+    }
+    result = await proxy.fetch(url, headers)
+
+    content_type = (result.header("content-type") or "text/html").encode("latin-1")
+    if result.stream is not None or result.path is not None:
+        chunks = result.stream or streaming.iter_file(
+            result.path, result.offset, result.count
+        )
 
-def get_access_url(headers: Mapping):
-    return headers.get("Origin", DEFAULT_ACCESS_URL)
+        async def body():
+            async for chunk in chunks:
+                yield chunk
 
+        content = StreamedContent(content_type, body)
+    else:
+        content = Content(content_type, result.body)
 
-def copy_proxy_headers(proxy_response, response) -> None:
-    HEADERS = [
-        "Content-Disposition",
-        "Content-Type",
-        "Date",
-        "Last-Modified",
-        "Vary",
-        "Cache-Control",
-        "Etag",
-        "Accept-Ranges",
-        "Content-Range",
+    response_headers = [
+        (k.encode("latin-1"), v.encode("latin-1"))
+        for k, v in result.headers
+        if k.lower() != "content-type"
     ]
-    for k, v in proxy_response.headers.items():
-        k = k.title()
-        if k in HEADERS:
-            response.headers[k] = v
+    return blacksheep.Response(result.status, response_headers, content)
+
+
+app = metrics.MetricsMiddleware(tracing.TracingMiddleware(proxy_app))
 
 
 def main(host="localhost", port=8000, server="uvicorn"):
@@ -1,18 +1,15 @@
 import asyncio
 import traceback
-from typing import Mapping
 
 import falcon.asgi
 import fire
-import httpx
 import uvicorn
 
-# Extremely aggressive and hardcoded value
-from httpx import Timeout, TooManyRedirects
-
-TIMEOUT = 10
-
-DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
+import metrics
+import proxy
+import streaming
+import tracing
+import upstream
 
 
 class ProxyResource:
@@ -24,86 +21,35 @@ class ProxyResource:
 
     async def _on_get(self, request, response):
         url = request.get_param("url")
+        result = await proxy.fetch(url, request.headers)
 
-        proxy_query_header = make_request_headers(request.headers)
+        response.status = result.status
+        for k, v in result.headers:
+            response.append_header(k, v)
+        if result.stream is not None:
+            response.stream = result.stream
+        elif result.path is not None:
+            response.stream = streaming.iter_file(
+                result.path, result.offset, result.count
+            )
+            response.content_length = result.content_length()
+        else:
+            response.data = result.body
 
-        body = b""
 
-        try:
-            async with httpx.AsyncClient() as client:
-                proxy_response = await client.get(
-                    url, headers=proxy_query_header, timeout=TIMEOUT
-                )
-
-        # except SSLError:
-        #     # Invalid SSL Certificate
-        #     status = 526
-        except ConnectionError:
-            status = 523
-        except Timeout:
-            status = 524
-        except TooManyRedirects:
-            status = 520
-        else:
-            body = proxy_response.content
-            if proxy_response.status_code == 500:
-                status = 520
-            else:
-                status = 200
-
-        headers = []
-        if status == 200:
-            copy_proxy_headers(proxy_response, response)
-            response.append_header(
-                "Access-Control-Allow-Origin", get_access_url(request.headers)
-            )
+class UpstreamLifespan:
+    async def process_startup(self, scope, event):
+        await upstream.startup()
 
-        response.data = body
-
-
-app = falcon.asgi.App()
-proxy = ProxyResource()
-app.add_route("/", proxy)
-
-
-def make_request_headers(headers):
-    request_headers = {}
-    HEADERS = [
-        "Content-Type",
-        "Accept",
-        "Accept-Language",
-        "Range",
-        "If-Modified-Since",
-        "If-None-Match",
-    ]
-    for k in HEADERS:
-        v = headers.get(k.encode("ascii"))
-        if v:
-            request_headers[k] = str(v)
-
-    return request_headers
-
-
-def get_access_url(headers: Mapping):
-    return headers.get("Origin", DEFAULT_ACCESS_URL)
-
-
-def copy_proxy_headers(proxy_response, response) -> None:
-    HEADERS = [
-        "Content-Disposition",
-        "Content-Type",
-        "Date",
-        "Last-Modified",
-        "Vary",
-        "Cache-Control",
-        "Etag",
-        "Accept-Ranges",
-        "Content-Range",
-    ]
-    for k, v in proxy_response.headers.items():
-        k = k.title()
-        if k in HEADERS:
-            response.append_header(k, v)
+    async def process_shutdown(self, scope, event):
+        await upstream.shutdown()
+
+
+proxy_app = falcon.asgi.App(middleware=[UpstreamLifespan()])
+proxy_resource = ProxyResource()
+proxy_app.add_route("/", proxy_resource)
+
+app = metrics.MetricsMiddleware(tracing.TracingMiddleware(proxy_app))
 
 
 def main(host="localhost", port=8000, server="uvicorn"):
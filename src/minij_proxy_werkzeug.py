@@ -4,9 +4,10 @@ import requests
 import werkzeug
 from gunicorn.app.base import BaseApplication
 
-# Extremely aggressive and hardcoded value
-
-TIMEOUT = 10
+import breaker
+import hostlimits
+import streaming
+import timeouts
 
 DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
 
@@ -16,7 +17,7 @@ def application(environ, start_response):
     response = werkzeug.Response()
 
     if request.method != "GET":
-        response.status = 405
+        response.status_code = 405
     else:
         fetch_content(request, response)
 
@@ -27,21 +28,64 @@ def fetch_content(request: werkzeug.Request, response: werkzeug.Response) -> Non
     url = request.args["url"]
     proxy_query_header = make_request_headers(request.headers)
 
+    deadline = timeouts.client_deadline(request.headers)
+    limits = timeouts.get_timeouts(hostlimits.get_host(url))
+    circuit = breaker.get(url)
+    slot = hostlimits.thread_gate(url)
     try:
-        proxy_response = requests.get(url, headers=proxy_query_header, timeout=TIMEOUT)
+        timeouts.check(deadline)
+        circuit.check()
+        try:
+            slot.acquire()
+        except BaseException:
+            circuit.abandon()
+            raise
+        try:
+            proxy_response = requests.get(
+                url,
+                headers=proxy_query_header,
+                timeout=limits.capped(deadline).requests_timeout(),
+                stream=streaming.STREAMING,
+            )
+        except BaseException:
+            slot.release()
+            circuit.abandon()
+            raise
+    except timeouts.DeadlineExceeded:
+        response.status_code = 524
+    except breaker.CircuitOpen as e:
+        response.status_code = e.status
+        response.headers["Retry-After"] = str(e.retry_after)
+    except hostlimits.Overloaded:
+        response.status_code = 503
+        response.headers["Retry-After"] = str(hostlimits.RETRY_AFTER)
     except requests.exceptions.SSLError:
         # Invalid SSL Certificate
-        response.status = 526
+        response.status_code = 526
+        circuit.record(526)
     except requests.exceptions.ConnectionError:
-        response.status = 523
+        response.status_code = 523
+        circuit.record(523)
     except requests.exceptions.Timeout:
-        response.status = 524
+        response.status_code = 524
+        if not timeouts.expired(deadline):
+            circuit.record(524)
     except requests.exceptions.TooManyRedirects:
-        response.status = 520
+        response.status_code = 520
+        circuit.record(520)
     else:
-        response.body = proxy_response.content
+        circuit.record(proxy_response.status_code)
+        if streaming.STREAMING:
+            response.response = streaming.StreamingBody(
+                proxy_response, release=slot.release, deadline=deadline
+            )
+        else:
+            try:
+                response.body = proxy_response.content
+            finally:
+                slot.release()
         if proxy_response.status_code == 500:
-            response.status = 520
+            response.status_code = 520
         else:
             copy_proxy_headers(proxy_response, response)
 
@@ -55,6 +99,7 @@ def make_request_headers(headers: dict):
         "Accept",
         "Accept-Language",
         "Range",
+        "If-Range",
         "If-Modified-Since",
         "If-None-Match",
     ]
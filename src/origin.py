@@ -0,0 +1,305 @@
+"""
+Simulated upstream for the benchmarks, in place of a static file server.
+
+A static file server answers at once, with the same small body, and never
+fails; real origins do none of that.  This asyncio HTTP/1.1 server answers
+each request according to a `Profile`:
+
+- body sizes drawn from a log-normal distribution around a median;
+- latencies (time to the response headers) drawn the same way, plus a long
+  tail: a share of the requests waits `tail_latency` seconds more;
+- a share of the bodies sent chunked rather than with a ``Content-Length``;
+- cache headers (``Cache-Control``, ``ETag``, ``Last-Modified``) and
+  ``304 Not Modified`` answers to conditional requests, if enabled;
+- a share of errors, of connections reset partway through the body, and of
+  bodies dripped slowly, a chunk at a time.
+
+The query string of a request overrides the profile for that request, e.g.
+``/?size=1048576&latency=0.2``, so that a single origin can serve all the
+cells of a benchmark.  For instance::
+
+    python origin.py --port=8001 --size=20000 --size_sigma=1 --latency=0.05 \\
+        --tail_rate=0.01 --tail_latency=2 --error_rate=0.001
+"""
+
+import asyncio
+import math
+import random
+import socket
+import struct
+import time
+from dataclasses import dataclass, fields, replace
+from email.utils import formatdate
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import fire
+
+PORT = 8001
+
+# Body bytes written at a time
+CHUNK_SIZE = 64 * 1024
+
+# Longest request head accepted
+MAX_HEAD_SIZE = 64 * 1024
+
+# Words the bodies are made of, so that they compress like text does
+WORDS = (
+    b"proxy upstream origin cache request response header body latency "
+    b"worker socket stream chunk buffer client server timeout gateway"
+).split()
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+@dataclass
+class Profile:
+    # Median body size, in bytes, and the sigma of its log-normal
+    # distribution; 0 for always the median
+    size: int = 1024
+    size_sigma: float = 0.0
+    max_size: int = 100 * 1024 * 1024
+    # Median seconds before the response headers, and sigma, likewise
+    latency: float = 0.0
+    latency_sigma: float = 0.0
+    # Share of the requests waiting `tail_latency` more seconds
+    tail_rate: float = 0.0
+    tail_latency: float = 1.0
+    # Share of the bodies sent with chunked encoding
+    chunked_rate: float = 0.0
+    # Send validators and a max-age, and answer conditional requests
+    cache_headers: bool = False
+    max_age: int = 600
+    # Share of the requests answered with `error_status`
+    error_rate: float = 0.0
+    error_status: int = 503
+    # Share of the connections reset partway through the body
+    reset_rate: float = 0.0
+    # Share of the bodies sent `drip_size` bytes every `drip_interval` seconds
+    drip_rate: float = 0.0
+    drip_size: int = 1024
+    drip_interval: float = 0.1
+
+    def overridden(self, query: Dict[str, str]) -> "Profile":
+        """Copy with the fields given in a query string."""
+        changes = {}
+        for field in fields(self):
+            if field.name not in query:
+                continue
+            value = query[field.name]
+            if field.type in (bool, "bool"):
+                changes[field.name] = value.lower() in ("1", "true", "yes")
+            else:
+                changes[field.name] = type(getattr(self, field.name))(value)
+        return replace(self, **changes) if changes else self
+
+
+def make_block(seed: int) -> bytes:
+    rng = random.Random(seed)
+    text = b" ".join(rng.choice(WORDS) for _ in range(CHUNK_SIZE // 4))
+    return text[:CHUNK_SIZE]
+
+
+class Origin:
+    """Answers HTTP/1.1 requests as told by its `profile`."""
+
+    def __init__(self, profile: Profile, seed: Optional[int] = None):
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.block = make_block(0)
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.requests = 0
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                self.requests += 1
+                if not await self.respond(writer, *request):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        target: str,
+        headers: Dict[str, str],
+    ) -> bool:
+        """Answer a request; False once the connection is to be dropped."""
+        keep_alive = headers.get("connection", "").lower() != "close"
+        _, _, query_string = target.partition("?")
+        try:
+            profile = self.profile.overridden(dict(parse_qsl(query_string)))
+        except ValueError:
+            writer.write(head(400, [("Content-Length", "0")], keep_alive))
+            await writer.drain()
+            return keep_alive
+        rng = self.random
+
+        delay = draw(rng, profile.latency, profile.latency_sigma)
+        if rng.random() < profile.tail_rate:
+            delay += profile.tail_latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if rng.random() < profile.error_rate:
+            body = b"simulated error\n"
+            writer.write(
+                head(
+                    profile.error_status,
+                    [("Content-Length", str(len(body)))],
+                    keep_alive,
+                )
+            )
+            if method != "HEAD":
+                writer.write(body)
+            await writer.drain()
+            return keep_alive
+
+        size = min(int(draw(rng, profile.size, profile.size_sigma)), profile.max_size)
+        response_headers = [("Content-Type", "text/plain; charset=utf-8")]
+        if profile.cache_headers:
+            etag = f'"{size:x}"'
+            response_headers += [
+                ("Cache-Control", f"max-age={profile.max_age}, public"),
+                ("ETag", etag),
+                ("Last-Modified", self.last_modified),
+            ]
+            if headers.get("if-none-match") == etag:
+                writer.write(head(304, response_headers, keep_alive))
+                await writer.drain()
+                return keep_alive
+
+        chunked = rng.random() < profile.chunked_rate
+        if chunked:
+            response_headers.append(("Transfer-Encoding", "chunked"))
+        else:
+            response_headers.append(("Content-Length", str(size)))
+        writer.write(head(200, response_headers, keep_alive))
+        if method == "HEAD":
+            await writer.drain()
+            return keep_alive
+
+        reset_at = size // 2 if rng.random() < profile.reset_rate else None
+        if rng.random() < profile.drip_rate:
+            chunk_size, interval = max(1, profile.drip_size), profile.drip_interval
+        else:
+            chunk_size, interval = CHUNK_SIZE, 0.0
+        sent = 0
+        while sent < size:
+            if reset_at is not None and sent >= reset_at:
+                await writer.drain()
+                reset(writer)
+                return False
+            if interval and sent:
+                await asyncio.sleep(interval)
+            chunk = self.body_chunk(min(chunk_size, size - sent))
+            sent += len(chunk)
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            await writer.drain()
+        if reset_at is not None:
+            # An empty body has no middle
+            reset(writer)
+            return False
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive
+
+    def body_chunk(self, size: int) -> bytes:
+        if size <= len(self.block):
+            return self.block[:size]
+        return (self.block * (size // len(self.block) + 1))[:size]
+
+
+def draw(rng: random.Random, median: float, sigma: float) -> float:
+    """Value of a log-normal distribution, or the `median` without `sigma`."""
+    if sigma <= 0 or median <= 0:
+        return median
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+async def read_request(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[str, str, Dict[str, str]]]:
+    """Method, target and headers of the next request; None once closed."""
+    try:
+        data = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise ValueError("Request head too large")
+    lines = data.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    # Request bodies are read and ignored
+    length = int(headers.get("content-length") or 0)
+    if length:
+        await reader.readexactly(length)
+    return method, target, headers
+
+
+def head(status: int, headers, keep_alive: bool) -> bytes:
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}"]
+    lines.append(f"Date: {formatdate(usegmt=True)}")
+    lines += [f"{name}: {value}" for name, value in headers]
+    if not keep_alive:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def reset(writer: asyncio.StreamWriter) -> None:
+    """Close the connection with a TCP reset, as a crashing origin would."""
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    writer.transport.abort()
+
+
+async def serve(host: str, port: int, origin: Origin) -> None:
+    server = await asyncio.start_server(
+        origin.handle, host, port, limit=MAX_HEAD_SIZE, backlog=1024
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def main(
+    host: str = "localhost", port: int = PORT, seed: Optional[int] = None, **options
+):
+    """Serve on `host`:`port`, the `options` setting the `Profile` fields."""
+    names = {field.name for field in fields(Profile)}
+    unknown = set(options) - names
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+    origin = Origin(Profile(**options), seed)
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+    asyncio.run(serve(host, port, origin))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,889 @@
+"""
+Framework-neutral proxy pipeline shared by the httpx-based ASGI proxies.
+
+`fetch` turns a proxied GET into a `ProxyResponse`, answering from the
+worker's response cache when it can and from the upstream otherwise.  A
+`ProxyResponse` is itself an ASGI application, so raw ASGI and Starlette apps
+just await it; other frameworks copy its fields into their own response.
+"""
+
+import asyncio
+import os
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass, field, replace
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import httpx
+
+import breaker
+import cache
+import contentcoding
+import diskcache
+import hedging
+import hostlimits
+import metrics
+import ranges
+import singleflight
+import streaming
+import timeouts
+import tracing
+import upstream
+
+DEFAULT_ACCESS_URL = "https://mynij.app.officejs.com"
+
+# Set to False to always go to the upstream
+CACHING = True
+
+# Set to False to only cache in memory
+DISK_CACHING = True
+
+# A range of a body at most this large that is not in the cache yet makes
+# the whole body be fetched in the background, to serve the next ranges
+RANGE_UPGRADE_MAX_BYTES = 64 * 1024 * 1024
+
+# Chunks a shared body is read ahead of its readers
+BROADCAST_AHEAD = 4
+
+REQUEST_HEADERS = [
+    "content-type",
+    "accept",
+    "accept-language",
+    "range",
+    "if-range",
+    "if-modified-since",
+    "if-none-match",
+]
+
+# Only meaningful with a range
+RANGE_HEADERS = frozenset(["range", "if-range"])
+
+# Client headers read by `fetch`, on top of those sent to the upstream
+CLIENT_HEADERS = frozenset(
+    REQUEST_HEADERS
+    + ["accept-encoding", "cache-control", "origin"]
+    + [timeouts.DEADLINE_HEADER]
+)
+
+RESPONSE_HEADERS = frozenset(
+    [
+        "content-disposition",
+        "content-encoding",
+        "content-type",
+        "date",
+        "last-modified",
+        "vary",
+        "cache-control",
+        "etag",
+        "accept-ranges",
+        "content-range",
+    ]
+)
+
+# Names of the response headers as sent downstream
+RESPONSE_HEADER_NAMES = {name: name.title() for name in RESPONSE_HEADERS}
+
+# Headers kept on a 304 answered from the cache
+NOT_MODIFIED_HEADERS = frozenset(
+    ["cache-control", "date", "etag", "expires", "last-modified", "vary", "age"]
+)
+
+CONDITIONAL_HEADERS = frozenset(["if-none-match", "if-modified-since"])
+
+response_cache = cache.ResponseCache()
+
+disk_cache = diskcache.DiskCache()
+
+flights = singleflight.SingleFlight()
+
+# Background fetches for the cache, by URL and request headers
+_revalidations: Dict[Hashable, asyncio.Task] = {}
+
+# Pending writes to the disk cache
+_disk_writes: Set[asyncio.Task] = set()
+
+# Background reads of the bodies shared with the joiners of a flight
+_broadcasts: Set[asyncio.Task] = set()
+
+
+@dataclass
+class ProxyResponse:
+    status: int
+    headers: List[Tuple[str, str]] = field(default_factory=list)
+    body: bytes = b""
+    # Set instead of `body` when the upstream body is streamed through; it
+    # must be closed with `aclose()` if not read to the end
+    stream: Optional[AsyncIterator[bytes]] = None
+    # Set instead of `body` when the body is a file of the disk cache, of
+    # which only `count` bytes from `offset` are sent if `count` is set
+    path: Optional[str] = None
+    offset: int = 0
+    count: Optional[int] = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in self.headers]
+        if self.stream is None and self.status not in (204, 304):
+            headers.append((b"content-length", str(self.content_length()).encode()))
+        await send(
+            {"type": "http.response.start", "status": self.status, "headers": headers}
+        )
+        if self.stream is not None:
+            await streaming.send_stream(receive, send, self.stream)
+        elif self.path is not None:
+            await streaming.send_file(
+                scope, receive, send, self.path, self.offset, self.count
+            )
+        else:
+            await send({"type": "http.response.body", "body": self.body})
+
+    def header(self, name: str) -> Optional[str]:
+        return cache.get_header(self.headers, name)
+
+    def content_length(self) -> int:
+        if self.path is None:
+            return len(self.body)
+        if self.count is not None:
+            return self.count
+        return os.path.getsize(self.path) - self.offset
+
+    def copy(self) -> "ProxyResponse":
+        """Copy of a buffered response, safe to hand to another request."""
+        return replace(self, headers=list(self.headers))
+
+
+async def fetch(url: str, headers: Mapping[str, str]) -> ProxyResponse:
+    """Proxy a GET of `url`; `headers` are the client's, with lower-case names."""
+    tracing.mark("fetch")
+    request_headers = make_request_headers(headers)
+    cache_control = cache.parse_cache_control(headers.get("cache-control"))
+    byte_range = request_headers.get("range")
+    deadline = timeouts.client_deadline(headers)
+
+    if not CACHING or "no-store" in cache_control:
+        response = await fetch_upstream(
+            url, request_headers, store=False, deadline=deadline
+        )
+    elif byte_range:
+        # Ranges are of the unencoded body: those of a body the proxy
+        # compressed would be offsets in its own encoding
+        request_headers["accept-encoding"] = "identity"
+        response = await fetch_range(url, request_headers, cache_control, deadline)
+    else:
+        entry = await lookup(url, request_headers)
+        if entry is None:
+            response = await fetch_shared(url, request_headers, deadline=deadline)
+        elif "no-cache" in cache_control:
+            response = await fetch_shared(url, request_headers, entry, deadline)
+        elif entry.is_fresh():
+            response = cached_response(entry)
+        elif entry.allows_stale("stale-while-revalidate"):
+            revalidate_in_background(url, request_headers, entry)
+            response = cached_response(entry)
+        else:
+            response = await fetch_shared(url, request_headers, entry, deadline)
+
+    if (
+        response.status == 200
+        and response.stream is None
+        and (headers.get("if-none-match") or headers.get("if-modified-since"))
+        and cache.is_not_modified(response.headers, headers)
+    ):
+        response = not_modified(response)
+
+    if (
+        byte_range
+        and response.status == 200
+        and response.stream is None
+        and response.header("content-encoding") is None
+        and ranges.if_range_matches(response.headers, headers.get("if-range"))
+    ):
+        response = range_response(response, byte_range)
+
+    response.headers.append(("Access-Control-Allow-Origin", get_access_url(headers)))
+    return response
+
+
+async def fetch_range(
+    url: str,
+    request_headers: Mapping[str, str],
+    cache_control: Dict,
+    deadline: Optional[float] = None,
+) -> ProxyResponse:
+    """Fetch `url` for a Range request.
+
+    Returns the whole body if it is in the cache, for `fetch` to cut the
+    ranges from, and the upstream's answer to the Range request otherwise,
+    the upstream checking its ``If-Range``.
+    """
+    full_headers = {k: v for k, v in request_headers.items() if k not in RANGE_HEADERS}
+    entry = await lookup(url, full_headers)
+    if entry is not None and entry.status == 200 and "no-cache" not in cache_control:
+        if entry.is_fresh():
+            return cached_response(entry)
+        if entry.allows_stale("stale-while-revalidate"):
+            revalidate_in_background(url, full_headers, entry)
+            return cached_response(entry)
+
+    # An upstream ignoring the range answers with the whole body, which is
+    # stored as usual
+    response = await fetch_upstream(url, request_headers, store=True, deadline=deadline)
+    size = ranges.content_range_size(response.header("content-range"))
+    if (
+        response.status == 206
+        and size is not None
+        and size <= RANGE_UPGRADE_MAX_BYTES
+        and cache.make_entry(200, response.headers, time.time(), time.time())
+    ):
+        revalidate_in_background(url, full_headers, entry)
+    return response
+
+
+async def lookup(
+    url: str, request_headers: Mapping[str, str]
+) -> Optional[cache.CacheEntry]:
+    """Look `url` up in memory, then on disk from a thread."""
+    entry = response_cache.lookup(url, request_headers)
+    if entry is not None and entry.path is not None and not os.path.exists(entry.path):
+        # Evicted from the disk by another worker
+        response_cache.invalidate(url)
+        entry = None
+    if entry is None and DISK_CACHING:
+        loop = asyncio.get_running_loop()
+        try:
+            entry = await loop.run_in_executor(
+                None, disk_cache.lookup, url, request_headers
+            )
+        except (OSError, sqlite3.Error):
+            # A broken disk is a miss
+            return None
+        if entry is not None:
+            # Only the metadata: the body stays on disk
+            response_cache.store(url, request_headers, entry)
+    return entry
+
+
+def store_entry(
+    url: str,
+    request_headers: Mapping[str, str],
+    entry: cache.CacheEntry,
+) -> None:
+    """Store an entry with a buffered body, or a refreshed entry."""
+    response_cache.store(url, request_headers, entry)
+    if DISK_CACHING:
+        body = entry.body if entry.path is None else None
+        write_in_background(store_on_disk(url, request_headers, entry, body))
+
+
+def write_in_background(coroutine: Awaitable) -> None:
+    task = asyncio.ensure_future(coroutine)
+    _disk_writes.add(task)
+    task.add_done_callback(_disk_writes.discard)
+
+
+async def store_on_disk(
+    url: str,
+    request_headers: Mapping[str, str],
+    entry: cache.CacheEntry,
+    body: Union[bytes, diskcache.BodyWriter, None],
+) -> Optional[str]:
+    """Store `entry` in the disk cache from a thread; return its body file."""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            None,
+            disk_cache.store,
+            url,
+            request_headers,
+            diskcache.snapshot(entry),
+            body,
+        )
+    except (OSError, sqlite3.Error):
+        # A full or broken disk must not break the proxy
+        if isinstance(body, diskcache.BodyWriter):
+            body.discard()
+        return None
+
+
+async def fetch_shared(
+    url: str,
+    request_headers: Mapping[str, str],
+    stale: Optional[cache.CacheEntry] = None,
+    deadline: Optional[float] = None,
+) -> ProxyResponse:
+    """Fetch `url` for the cache, sharing the fetch with concurrent callers.
+
+    The first caller streams the upstream response as usual; the others wait
+    for its headers and get its body as it arrives, or the same error.  Only
+    cacheable or explicitly public responses are shared.  When there is
+    nothing to share (the response is private, or its body went past the
+    start of a large one), they fetch on their own.
+    """
+    key = fetch_key(url, request_headers)
+    flight = flights.get(key)
+    if flight is not None:
+        limits = timeouts.get_timeouts(hostlimits.get_host(url)).capped(deadline)
+        shared = await flight.wait(limits.first_byte)
+        tracing.mark("flight")
+        response = shared.copy() if shared is not None else None
+        if response is not None:
+            flights.joined()
+            return response
+        return await fetch_upstream(
+            url, request_headers, True, stale, deadline=deadline
+        )
+
+    flight = flights.start(key)
+    try:
+        return await fetch_upstream(url, request_headers, True, stale, flight, deadline)
+    except BaseException:
+        flight.finish(None)
+        raise
+
+
+async def fetch_upstream(
+    url: str,
+    request_headers: Mapping[str, str],
+    store: bool,
+    stale: Optional[cache.CacheEntry] = None,
+    flight: Optional[singleflight.Flight] = None,
+    deadline: Optional[float] = None,
+) -> ProxyResponse:
+    """Fetch `url` from the upstream, giving up at the client's `deadline`.
+
+    If a `stale` entry is given, it is revalidated with a conditional request
+    and served from the cache if the upstream answers ``304 Not Modified``,
+    or cannot be reached and the entry allows ``stale-if-error``.
+    The response is shared with the joiners of the `flight`, if given and
+    the response is shareable.
+    """
+    validators = stale.validators() if stale is not None else {}
+    if validators:
+        upstream_headers = {
+            k: v for k, v in request_headers.items() if k not in CONDITIONAL_HEADERS
+        }
+        upstream_headers.update(validators)
+    else:
+        upstream_headers = request_headers
+
+    if timeouts.expired(deadline):
+        if flight is not None:
+            flight.finish(None)
+        return ProxyResponse(524)
+    limits = timeouts.get_timeouts(hostlimits.get_host(url)).capped(deadline)
+    # The body must be in by the end of the total timeout, counted from now,
+    # and by the client's deadline, which `capped` already took into account
+    body_deadline = None
+    if limits.total is not None:
+        body_deadline = time.monotonic() + limits.total
+
+    client = upstream.get_httpx_client()
+    proxy_request = client.build_request("GET", url, headers=upstream_headers)
+
+    circuit = breaker.get(url)
+    if not circuit.allow():
+        response = upstream_error(circuit.failure_status, stale, circuit.retry_after())
+        if flight is not None:
+            flight.finish(response.copy())
+        return response
+
+    slot = hostlimits.gate(url)
+    try:
+        await slot.acquire()
+    except BaseException as e:
+        circuit.abandon()
+        if not isinstance(e, hostlimits.Overloaded):
+            raise
+        response = ProxyResponse(503, [("Retry-After", str(hostlimits.RETRY_AFTER))])
+        if flight is not None:
+            flight.finish(response.copy())
+        return response
+    tracing.mark("slot")
+
+    request_time = time.time()
+    start = time.perf_counter()
+    try:
+        proxy_response = await send_upstream(client, proxy_request, url, limits)
+    except httpx.HTTPError as e:
+        slot.release()
+        status = upstream.error_status(e)
+        if timeouts.expired(deadline):
+            # The client gave up, which says nothing about the upstream
+            circuit.abandon()
+            if flight is not None:
+                flight.finish(None)
+            return ProxyResponse(status)
+        circuit.record(status)
+        response = upstream_error(status, stale)
+        if flight is not None:
+            flight.finish(response.copy())
+        return response
+    except BaseException:
+        slot.release()
+        circuit.abandon()
+        raise
+    response_time = time.time()
+    tracing.mark("headers")
+    metrics.upstream_first_byte.observe(time.perf_counter() - start)
+    circuit.record(proxy_response.status_code)
+
+    response_headers = proxy_response.headers.multi_items()
+    if validators and proxy_response.status_code == 304:
+        await proxy_response.aclose()
+        slot.release()
+        response_headers = contentcoding.stored_representation(
+            response_headers, stale.headers
+        )
+        stale.refresh(response_headers, request_time, response_time)
+        store_entry(url, request_headers, stale)
+        response = cached_response(stale)
+        if flight is not None:
+            flight.finish(response.copy())
+        return response
+
+    accepted = contentcoding.codings(request_headers.get("accept-encoding", ""))
+    coding = proxy_response.headers.get("content-encoding", "identity").lower()
+    # Passed through as is if the client accepts it, decoded otherwise
+    raw = coding in accepted
+    compress_with = None
+    if raw or contentcoding.is_compressible(response_headers):
+        response_headers = contentcoding.add_vary(response_headers)
+    if coding != "identity" and not raw:
+        response_headers = [
+            (k, v) for k, v in response_headers if k.lower() != "content-encoding"
+        ]
+    elif (
+        coding == "identity"
+        and accepted
+        and proxy_response.status_code == 200
+        and contentcoding.should_compress(response_headers)
+    ):
+        compress_with = accepted[0]
+        response_headers = contentcoding.encoded_headers(
+            response_headers, compress_with
+        )
+
+    if proxy_response.status_code == 500:
+        response = ProxyResponse(520)
+    else:
+        response = ProxyResponse(
+            proxy_response.status_code, filter_response_headers(response_headers)
+        )
+
+    body = streaming.iter_httpx(
+        proxy_response, release=slot.release, raw=raw, deadline=body_deadline
+    )
+    if compress_with is not None:
+        body = contentcoding.compress(body, compress_with)
+    entry = None
+    if store:
+        entry = cache.make_entry(
+            proxy_response.status_code, response_headers, request_time, response_time
+        )
+
+    if entry is not None:
+
+        def complete(
+            content: Optional[bytes], spool: Optional[diskcache.BodyWriter]
+        ) -> None:
+            if spool is not None:
+                write_in_background(complete_on_disk(spool))
+            elif content is not None:
+                entry.body = content
+                store_entry(url, request_headers, entry)
+
+        async def complete_on_disk(spool: diskcache.BodyWriter) -> None:
+            path = await store_on_disk(url, request_headers, entry, spool)
+            if path is not None:
+                entry.path = path
+                response_cache.store(url, request_headers, entry)
+
+        spool = disk_cache if DISK_CACHING else None
+        body = RecordedBody(body, response_cache.max_entry_bytes, complete, spool)
+
+    if flight is not None and entry is None and not is_public(response.headers):
+        flight.finish(None)
+        flight = None
+
+    if streaming.STREAMING:
+        if flight is not None:
+            body = broadcast(body, response, flight)
+        response.stream = body
+        return response
+    try:
+        response.body = b"".join([chunk async for chunk in body])
+    except (httpx.HTTPError, TimeoutError) as e:
+        # Nothing has been sent downstream yet, so the failure of the body
+        # is answered like that of the headers
+        if isinstance(e, httpx.HTTPError):
+            status = upstream.error_status(e)
+        else:
+            status = breaker.TIMEOUT_STATUS
+        if timeouts.expired(deadline):
+            response = ProxyResponse(status)
+            if flight is not None:
+                flight.finish(None)
+            return response
+        response = upstream_error(status, stale)
+    if flight is not None:
+        flight.finish(response.copy())
+    return response
+
+
+def is_public(headers: cache.Headers) -> bool:
+    """Whether a response not stored in the cache may still be shared."""
+    cache_control = cache.parse_cache_control(
+        cache.get_header(headers, "cache-control")
+    )
+    return (
+        "public" in cache_control
+        and "private" not in cache_control
+        and "no-store" not in cache_control
+    )
+
+
+@dataclass
+class SharedResponse:
+    """Response of a flight whose body is still arriving."""
+
+    status: int
+    headers: List[Tuple[str, str]]
+    body: singleflight.Broadcast
+
+    def copy(self) -> Optional[ProxyResponse]:
+        """Response streaming the body from its start, or None if too late."""
+        reader = self.body.reader()
+        if reader is None:
+            return None
+        return ProxyResponse(self.status, list(self.headers), stream=reader)
+
+
+def broadcast(
+    body: AsyncIterator[bytes], response: ProxyResponse, flight: singleflight.Flight
+) -> AsyncIterator[bytes]:
+    """Share `response` with the joiners of `flight`, its `body` being read in
+    the background for all of them; returns the first caller's reader."""
+    shared = singleflight.Broadcast(response_cache.max_entry_bytes)
+    reader = shared.reader()
+    flight.publish(SharedResponse(response.status, list(response.headers), shared))
+    task = asyncio.ensure_future(pump(body, shared, flight))
+    _broadcasts.add(task)
+    task.add_done_callback(_broadcasts.discard)
+    return reader
+
+
+async def pump(
+    body: AsyncIterator[bytes],
+    shared: singleflight.Broadcast,
+    flight: singleflight.Flight,
+) -> None:
+    """Read `body` into `shared` as fast as its readers go, until none is left."""
+    error: Optional[BaseException] = None
+    try:
+        async for chunk in body:
+            shared.append(chunk)
+            await shared.wait_for_readers(BROADCAST_AHEAD)
+            if not shared.readers:
+                error = singleflight.BroadcastAborted()
+                break
+    except Exception as e:
+        error = e
+    except BaseException:
+        error = singleflight.BroadcastAborted()
+        raise
+    finally:
+        flight.end()
+        shared.close(error)
+        await body.aclose()
+
+
+async def send_upstream(
+    client: httpx.AsyncClient,
+    proxy_request: httpx.Request,
+    url: str,
+    limits: timeouts.Timeouts,
+) -> httpx.Response:
+    """Send a GET for a streamed response, hedged if `hedging.HEDGING`.
+
+    The response headers must arrive within `limits.first_byte`.
+    """
+    timeout = httpx.Timeout(
+        connect=limits.connect, read=limits.read, write=limits.read, pool=limits.pool
+    )
+
+    def attempt() -> Awaitable[httpx.Response]:
+        return client.send(proxy_request, stream=True, timeout=timeout)
+
+    if hedging.HEDGING:
+        response = hedging.race(
+            attempt, hostlimits.get_host(url), httpx.Response.aclose
+        )
+    else:
+        response = attempt()
+    try:
+        return await asyncio.wait_for(response, limits.first_byte)
+    except asyncio.TimeoutError:
+        raise httpx.ReadTimeout(
+            "No response headers in time", request=proxy_request
+        ) from None
+
+
+def fetch_key(url: str, request_headers: Mapping[str, str]) -> Hashable:
+    return cache.normalize_url(url), frozenset(request_headers.items())
+
+
+def revalidate_in_background(
+    url: str,
+    request_headers: Mapping[str, str],
+    entry: Optional[cache.CacheEntry] = None,
+) -> None:
+    """Fetch `url` into the cache, revalidating `entry` if given."""
+    key = fetch_key(url, request_headers)
+    if key in _revalidations:
+        return
+    task = asyncio.ensure_future(revalidate(url, request_headers, entry))
+    _revalidations[key] = task
+    task.add_done_callback(lambda task: _revalidations.pop(key, None))
+
+
+async def revalidate(
+    url: str,
+    request_headers: Mapping[str, str],
+    entry: Optional[cache.CacheEntry] = None,
+) -> None:
+    try:
+        response = await fetch_shared(url, request_headers, entry)
+        # Reading the new body is what stores it
+        if response.stream is not None:
+            async for _ in response.stream:
+                pass
+    except httpx.HTTPError:
+        pass
+
+
+def flight_samples() -> Iterable[metrics.Sample]:
+    """`metrics` samples of the shared fetches."""
+    flight_stats = flights.stats()
+    yield "minij_flights_in_flight", "", flight_stats["in_flight"]
+    yield "minij_flights_started_total", "", flight_stats["started"]
+    yield "minij_flights_collapsed_total", "", flight_stats["collapsed"]
+    yield "minij_flights_timeouts_total", "", flight_stats["timeouts"]
+
+
+metrics.collectors.append(flight_samples)
+
+
+class RecordedBody:
+    """Pass a body through, keeping a copy of it for later use.
+
+    Bodies larger than `max_size` are written to a file of the `spool` disk
+    cache instead, up to its own `max_entry_bytes`.  `on_complete` is called
+    exactly once: after the last chunk with either the whole body or the
+    file it was written to, or with None for both if the body was too large
+    or was closed before the end.
+    """
+
+    def __init__(
+        self,
+        chunks: AsyncGenerator[bytes, None],
+        max_size: int,
+        on_complete: Callable[[Optional[bytes], Optional[diskcache.BodyWriter]], None],
+        spool: Optional[diskcache.DiskCache] = None,
+    ):
+        self.chunks = chunks
+        self.max_size = max_size
+        self.on_complete = on_complete
+        self.spool = spool
+        self.parts: Optional[List[bytes]] = []
+        self.writer: Optional[diskcache.BodyWriter] = None
+        self.size = 0
+        self.done = False
+
+    def __aiter__(self) -> "RecordedBody":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.done:
+            raise StopAsyncIteration
+        try:
+            chunk = await self.chunks.__anext__()
+        except StopAsyncIteration:
+            self.finish(complete=True)
+            raise
+        except BaseException:
+            await self.aclose()
+            raise
+        self.size += len(chunk)
+        if self.writer is not None:
+            self.write(chunk)
+        elif self.parts is not None:
+            self.parts.append(chunk)
+            if self.size > self.max_size:
+                self.spill()
+        return chunk
+
+    def spill(self) -> None:
+        parts, self.parts = self.parts, None
+        if self.spool is None:
+            return
+        try:
+            self.writer = self.spool.writer()
+        except (OSError, sqlite3.Error):
+            return
+        for part in parts:
+            self.write(part)
+
+    def write(self, chunk: bytes) -> None:
+        if self.size > self.spool.max_entry_bytes:
+            self.writer.discard()
+            self.writer = None
+            return
+        try:
+            self.writer.write(chunk)
+        except OSError:
+            self.writer.discard()
+            self.writer = None
+
+    async def aclose(self) -> None:
+        await self.chunks.aclose()
+        self.finish(complete=False)
+
+    def finish(self, complete: bool) -> None:
+        if self.done:
+            return
+        self.done = True
+        content, writer = None, self.writer
+        if complete and self.parts is not None:
+            content = b"".join(self.parts)
+        elif writer is not None and not complete:
+            writer.discard()
+            writer = None
+        self.parts = self.writer = None
+        self.on_complete(content, writer)
+
+
+def cached_response(entry: cache.CacheEntry) -> ProxyResponse:
+    headers = filter_response_headers(entry.headers)
+    headers.append(("Age", str(int(entry.current_age()))))
+    if entry.status == 200 and entry.header("accept-ranges") is None:
+        # Ranges of cached bodies are served locally
+        headers.append(("Accept-Ranges", "bytes"))
+    if entry.path is not None:
+        return ProxyResponse(entry.status, headers, path=entry.path)
+    return ProxyResponse(entry.status, headers, entry.body)
+
+
+def range_response(response: ProxyResponse, value: str) -> ProxyResponse:
+    """Cut the ranges asked for by the `value` of a Range header from a
+    complete response.
+    """
+    size = response.content_length()
+    byte_ranges = ranges.parse_range(value, size)
+    if byte_ranges is None:
+        return response
+    if not byte_ranges:
+        return ProxyResponse(416, [("Content-Range", f"bytes */{size}")])
+
+    if len(byte_ranges) == 1:
+        start, end = byte_ranges[0]
+        headers = response.headers + [
+            ("Content-Range", ranges.content_range(byte_ranges[0], size))
+        ]
+        if response.path is not None:
+            offset, count = response.offset + start, end - start + 1
+            return ProxyResponse(
+                206, headers, path=response.path, offset=offset, count=count
+            )
+        return ProxyResponse(206, headers, response.body[start : end + 1])
+
+    boundary = uuid.uuid4().hex
+    parts = list(
+        ranges.multipart(byte_ranges, size, response.header("content-type"), boundary)
+    )
+    headers = [(k, v) for k, v in response.headers if k.lower() != "content-type"]
+    headers.append(("Content-Type", f"multipart/byteranges; boundary={boundary}"))
+
+    if response.path is None:
+        body = b"".join(
+            part if isinstance(part, bytes) else response.body[part[0] : part[1] + 1]
+            for part in parts
+        )
+        return ProxyResponse(206, headers, body)
+
+    length = sum(
+        len(part) if isinstance(part, bytes) else part[1] - part[0] + 1
+        for part in parts
+    )
+    headers.append(("Content-Length", str(length)))
+
+    async def body() -> AsyncIterator[bytes]:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, end = part
+            offset = response.offset + start
+            async for chunk in streaming.iter_file(
+                response.path, offset, end - start + 1
+            ):
+                yield chunk
+
+    return ProxyResponse(206, headers, stream=body())
+
+
+def upstream_error(
+    status: int, stale: Optional[cache.CacheEntry], retry_after: Optional[int] = None
+) -> ProxyResponse:
+    """Answer a failure to reach the upstream, with `stale` if it allows it."""
+    if stale is not None and stale.allows_stale("stale-if-error"):
+        return cached_response(stale)
+    headers = []
+    if retry_after is not None:
+        headers.append(("Retry-After", str(retry_after)))
+    return ProxyResponse(status, headers)
+
+
+def not_modified(response: ProxyResponse) -> ProxyResponse:
+    headers = [(k, v) for k, v in response.headers if k.lower() in NOT_MODIFIED_HEADERS]
+    return ProxyResponse(304, headers)
+
+
+def make_request_headers(headers: Mapping[str, str]) -> dict:
+    request_headers = {}
+    for k in REQUEST_HEADERS:
+        v = headers.get(k)
+        if v:
+            request_headers[k] = str(v)
+
+    # Also the key of the encoded variants in the cache
+    request_headers["accept-encoding"] = contentcoding.negotiate(
+        headers.get("accept-encoding")
+    )
+    return request_headers
+
+
+def filter_response_headers(headers: cache.Headers) -> List[Tuple[str, str]]:
+    filtered = []
+    for k, v in headers:
+        name = RESPONSE_HEADER_NAMES.get(k.lower())
+        if name is not None:
+            filtered.append((name, v))
+    return filtered
+
+
+def get_access_url(headers: Mapping[str, str]) -> str:
+    return headers.get("origin", DEFAULT_ACCESS_URL)
@@ -0,0 +1,111 @@
+"""
+``Range`` requests answered from a complete cached body (RFC 9110, 14).
+
+Only the ``bytes`` unit is supported.  A header that cannot be parsed, or that
+asks for too many ranges, is ignored and the whole body is sent, as the RFC
+allows.
+"""
+
+import re
+from typing import Iterator, List, Optional, Tuple, Union
+
+from cache import Headers, get_header, parse_http_date
+
+# More ranges than this in one request are ignored
+MAX_RANGES = 16
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(?:\d+-\d+|\*)/(\d+)")
+
+# Inclusive first and last byte positions
+ByteRange = Tuple[int, int]
+
+
+def parse_range(value: str, size: int) -> Optional[List[ByteRange]]:
+    """Return the satisfiable ranges of a ``Range`` header for a body of `size`.
+
+    None means the header is to be ignored; an empty list means no range is
+    satisfiable (``416 Range Not Satisfiable``).
+    """
+    unit, sep, specs = value.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    count = 0
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        count += 1
+        if count > MAX_RANGES:
+            return None
+        first, dash, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            # Suffix range: the last `last` bytes
+            length = int(last)
+            if length and size:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            end = int(last) if last else size - 1
+            ranges.append((start, min(end, size - 1)))
+
+    if not count:
+        return None
+    return ranges
+
+
+def content_range(byte_range: ByteRange, size: int) -> str:
+    return f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+
+
+def content_range_size(value: Optional[str]) -> Optional[int]:
+    """Complete length given by a ``Content-Range`` header, if known."""
+    match = CONTENT_RANGE_RE.match(value or "")
+    return int(match.group(1)) if match else None
+
+
+def if_range_matches(headers: Headers, value: Optional[str]) -> bool:
+    """Whether the ``If-Range`` condition `value` holds for a stored response.
+
+    Only strong validators match: an entity tag compared strongly, or a
+    date equal to ``Last-Modified``.
+    """
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith("W/"):
+        return False
+    if value.startswith('"'):
+        etag = get_header(headers, "etag")
+        return etag is not None and etag.strip() == value
+    date = parse_http_date(value)
+    last_modified = parse_http_date(get_header(headers, "last-modified"))
+    return date is not None and date == last_modified
+
+
+def multipart(
+    ranges: List[ByteRange], size: int, content_type: Optional[str], boundary: str
+) -> Iterator[Union[bytes, ByteRange]]:
+    """Parts of a ``multipart/byteranges`` body.
+
+    Yields the delimiters and part headers as bytes and, between them, the
+    ranges of the body to send.
+    """
+    for byte_range in ranges:
+        head = f"\r\n--{boundary}\r\n"
+        if content_type:
+            head += f"Content-Type: {content_type}\r\n"
+        head += f"Content-Range: {content_range(byte_range, size)}\r\n\r\n"
+        yield head.encode("latin-1")
+        yield byte_range
+    yield f"\r\n--{boundary}--\r\n".encode("latin-1")
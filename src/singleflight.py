@@ -0,0 +1,205 @@
+"""
+Request coalescing ("single-flight") for concurrent identical fetches.
+
+The first caller for a key starts a flight and does the actual work; callers
+arriving while it is in flight wait for its result instead of starting their
+own.  The result may be published before the work is over, for instance as
+soon as the response headers are in, with a `Broadcast` of the body still
+arriving: the flight then takes new joiners until it ends.  Nothing is kept
+once a flight has ended: caching is someone else's job.
+"""
+
+import asyncio
+from typing import Any, Dict, Hashable, List, Optional, Set
+
+
+class BroadcastAborted(Exception):
+    """A broadcast was given up before the end of its body."""
+
+
+class Broadcast:
+    """Chunks of a body as they arrive, each reader getting all of them.
+
+    The chunks are kept for new readers to start from the beginning, up to
+    `max_size` bytes; past that, the broadcast takes no new readers and only
+    keeps the chunks some reader has yet to get.  Readers of a body that
+    ended early get the same error.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.chunks: List[bytes] = []
+        # Index in the body of the first chunk kept
+        self.first = 0
+        self.size = 0
+        self.readers: Set["BroadcastReader"] = set()
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self._read = asyncio.Event()
+
+    @property
+    def end(self) -> int:
+        return self.first + len(self.chunks)
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self._trim()
+        self._wake()
+
+    def _trim(self) -> None:
+        behind = min((r.position for r in self.readers), default=self.end)
+        del self.chunks[: behind - self.first]
+        self.first = behind
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """End the body, early if there is an `error`."""
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _wake_writer(self) -> None:
+        self._read.set()
+        self._read = asyncio.Event()
+
+    async def wait_for_readers(self, ahead: int) -> None:
+        """Wait until the readers are at most `ahead` chunks behind, or none is
+        left, so that the body arrives no faster than it is read.
+
+        The pace is that of the fastest reader, and past `max_size` that of
+        the slowest one, so that the chunks kept for it stay few.
+        """
+        while self.readers:
+            positions = [reader.position for reader in self.readers]
+            pace = min(positions) if self.size > self.max_size else max(positions)
+            if self.end - pace <= ahead:
+                break
+            await self._read.wait()
+
+    def reader(self) -> Optional["BroadcastReader"]:
+        """Iterator over the body from its start, or None if too late."""
+        if self.size > self.max_size or self.error is not None:
+            return None
+        return BroadcastReader(self)
+
+
+class BroadcastReader:
+    """Async iterator over the chunks of a `Broadcast`.
+
+    It counts as a reader from its creation until the end of the body or
+    `aclose()`.
+    """
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.position = 0
+        self.closed = False
+        broadcast.readers.add(self)
+
+    def __aiter__(self) -> "BroadcastReader":
+        return self
+
+    async def __anext__(self) -> bytes:
+        broadcast = self.broadcast
+        while not self.closed:
+            if self.position < broadcast.end:
+                chunk = broadcast.chunks[self.position - broadcast.first]
+                self.position += 1
+                if broadcast.size > broadcast.max_size:
+                    broadcast._trim()
+                broadcast._wake_writer()
+                return chunk
+            if broadcast.done:
+                self.close()
+                if broadcast.error is not None:
+                    raise broadcast.error
+                break
+            await broadcast._changed.wait()
+        raise StopAsyncIteration
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.broadcast.readers.discard(self)
+            self.broadcast._wake_writer()
+
+    async def aclose(self) -> None:
+        self.close()
+
+
+class Flight:
+    def __init__(self, group: "SingleFlight", key: Hashable):
+        self.group = group
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def publish(self, result: Any) -> None:
+        """Hand `result` to the waiters, and to those joining until `end()`.
+
+        Only the first call counts.
+        """
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def end(self) -> None:
+        """Stop taking joiners."""
+        if self.group._flights.get(self.key) is self:
+            del self.group._flights[self.key]
+
+    def finish(self, result: Any) -> None:
+        """Hand `result` to the waiters and end the flight."""
+        self.end()
+        self.publish(result)
+
+    async def wait(self, timeout: Optional[float] = None) -> Any:
+        """Wait for the flight's result, or return None after `timeout`.
+
+        A caller served with the result counts itself with `joined()`.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            self.group.timeouts += 1
+            return None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+        # Flights started, callers served by one instead, and joiners that
+        # gave up waiting
+        self.started = 0
+        self.collapsed = 0
+        self.timeouts = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def get(self, key: Hashable) -> Optional[Flight]:
+        return self._flights.get(key)
+
+    def start(self, key: Hashable) -> Flight:
+        flight = Flight(self, key)
+        self._flights[key] = flight
+        self.started += 1
+        return flight
+
+    def joined(self) -> None:
+        """Count a caller served by a flight instead of doing the work."""
+        self.collapsed += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "collapsed": self.collapsed,
+            "timeouts": self.timeouts,
+        }
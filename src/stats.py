@@ -0,0 +1,90 @@
+"""
+Summary statistics of the repeated runs of a benchmark cell.
+
+A single run says little: two cells whose throughputs differ by a few
+percent may well swap places on the next try.  `summarize` gives the mean,
+median, standard deviation and 95% confidence interval of the mean of the
+runs of a cell, and `distinguishable` tells whether two cells differ by more
+than their noise, with Welch's t-test.
+"""
+
+import math
+import statistics
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+# Two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom; beyond the table, that of the normal distribution
+T_95 = {
+    1: 12.706,
+    2: 4.303,
+    3: 3.182,
+    4: 2.776,
+    5: 2.571,
+    6: 2.447,
+    7: 2.365,
+    8: 2.306,
+    9: 2.262,
+    10: 2.228,
+    12: 2.179,
+    15: 2.131,
+    20: 2.086,
+    25: 2.060,
+    30: 2.042,
+    40: 2.021,
+    60: 2.000,
+    120: 1.980,
+}
+Z_95 = 1.960
+
+
+def t_critical(df: float) -> float:
+    """Critical value for `df` degrees of freedom, rounded down to the table."""
+    if df > max(T_95):
+        return Z_95
+    return T_95[max([d for d in T_95 if d <= df], default=1)]
+
+
+@dataclass
+class Summary:
+    n: int
+    mean: float
+    median: float
+    # None for a single value
+    stdev: Optional[float]
+    # Half-width of the 95% confidence interval of the mean
+    ci95: Optional[float]
+
+    @property
+    def low(self) -> Optional[float]:
+        return None if self.ci95 is None else self.mean - self.ci95
+
+    @property
+    def high(self) -> Optional[float]:
+        return None if self.ci95 is None else self.mean + self.ci95
+
+
+def summarize(values: Sequence[float]) -> Optional[Summary]:
+    """Summary of `values`, None if there are none."""
+    if not values:
+        return None
+    n = len(values)
+    stdev = statistics.stdev(values) if n > 1 else None
+    ci95 = None if stdev is None else t_critical(n - 1) * stdev / math.sqrt(n)
+    return Summary(n, statistics.fmean(values), statistics.median(values), stdev, ci95)
+
+
+def distinguishable(a: Summary, b: Summary) -> Optional[bool]:
+    """Whether the means of `a` and `b` differ at the 95% level.
+
+    None when either has a single value, so that its noise is unknown.
+    """
+    if a.stdev is None or b.stdev is None:
+        return None
+    var_a = a.stdev**2 / a.n
+    var_b = b.stdev**2 / b.n
+    if var_a + var_b == 0:
+        return a.mean != b.mean
+    # Welch–Satterthwaite degrees of freedom
+    df = (var_a + var_b) ** 2 / (var_a**2 / (a.n - 1) + var_b**2 / (b.n - 1))
+    return abs(a.mean - b.mean) > t_critical(df) * math.sqrt(var_a + var_b)
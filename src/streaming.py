@@ -0,0 +1,211 @@
+"""
+Streaming pass-through of upstream bodies.
+
+Instead of buffering the whole upstream body before sending the first byte,
+the proxies forward each chunk downstream as soon as it arrives.  A chunk is
+only read from the upstream once the previous one has been accepted by the
+server (``await send(...)`` / the WSGI server pulling the next item), so a
+slow client throttles the upstream read instead of filling our memory.
+Bodies of the disk cache are sent from their file in the same way.
+"""
+
+import asyncio
+import mmap
+import os
+import time
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+import httpx
+
+import metrics
+import singleflight
+import timeouts
+import tracing
+
+# Set to False to go back to buffering the whole upstream body in memory
+STREAMING = True
+
+# Upstream chunks are forwarded as they arrive, split to at most this size
+CHUNK_SIZE = 64 * 1024
+
+
+def split_chunk(chunk: bytes, chunk_size: int) -> Iterator[bytes]:
+    if len(chunk) <= chunk_size:
+        yield chunk
+        return
+    view = memoryview(chunk)
+    for start in range(0, len(chunk), chunk_size):
+        yield bytes(view[start : start + chunk_size])
+
+
+async def iter_httpx(
+    proxy_response,
+    release: Optional[Callable[[], None]] = None,
+    raw: bool = False,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[bytes]:
+    """Yield the body of a streamed `httpx.Response`, then close it.
+
+    `release` is called once the upstream response is closed, typically to
+    give back a `hostlimits` slot.  With `raw`, the body is not decoded
+    from its ``Content-Encoding``.  Each read is given until the
+    `time.monotonic` `deadline`, past which `TimeoutError` is raised.
+    """
+    chunks = proxy_response.aiter_raw() if raw else proxy_response.aiter_bytes()
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                if deadline is None:
+                    chunk = await chunks.__anext__()
+                else:
+                    left = deadline - time.monotonic()
+                    chunk = await asyncio.wait_for(chunks.__anext__(), left)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError("Upstream body not received in time") from None
+            metrics.add_received(len(chunk))
+            for piece in split_chunk(chunk, CHUNK_SIZE):
+                yield piece
+    finally:
+        metrics.upstream_body.observe(time.perf_counter() - start)
+        tracing.mark("upstream_body")
+        await proxy_response.aclose()
+        if release is not None:
+            release()
+
+
+async def iter_aiohttp(
+    proxy_response, release: Optional[Callable[[], None]] = None
+) -> AsyncIterator[bytes]:
+    """Yield the body of an `aiohttp.ClientResponse`, then release it."""
+    start = time.perf_counter()
+    try:
+        async for chunk in proxy_response.content.iter_chunked(CHUNK_SIZE):
+            metrics.add_received(len(chunk))
+            yield chunk
+    finally:
+        metrics.upstream_body.observe(time.perf_counter() - start)
+        tracing.mark("upstream_body")
+        proxy_response.release()
+        if release is not None:
+            release()
+
+
+async def send_stream(receive, send, chunks: AsyncIterator[bytes]) -> None:
+    """Send `chunks` as ASGI body messages, stopping if the client goes away.
+
+    `chunks` is closed with ``aclose()`` in any case.  If the upstream body
+    fails, the error is counted and the last body message is not sent, for
+    the server to drop the connection: the status is already gone, so that
+    is the only way left to tell the client its body was cut short.
+    """
+
+    async def forward() -> None:
+        try:
+            async for chunk in chunks:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        except (TimeoutError, httpx.TimeoutException):
+            metrics.add_body_error("timeout")
+            return
+        except (httpx.RequestError, singleflight.BroadcastAborted):
+            metrics.add_body_error("read")
+            return
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_for_disconnect() -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    forwarding = asyncio.ensure_future(forward())
+    disconnect = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await asyncio.wait(
+            [forwarding, disconnect], return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        forwarding.cancel()
+        disconnect.cancel()
+        await asyncio.wait([forwarding, disconnect])
+        # Closes the upstream response if forwarding never started
+        await chunks.aclose()
+    if not forwarding.cancelled():
+        forwarding.result()
+
+
+async def send_file(
+    scope, receive, send, path: str, offset: int = 0, count: Optional[int] = None
+) -> None:
+    """Send the file at `path`, or `count` bytes of it from `offset`.
+
+    Servers supporting the ``http.response.pathsend`` or
+    ``http.response.zerocopy`` ASGI extensions send it themselves, with
+    ``sendfile()``; otherwise it is sent in chunks read from a memory map.
+    """
+    extensions = scope.get("extensions") or {}
+    if "http.response.pathsend" in extensions and not offset and count is None:
+        await send({"type": "http.response.pathsend", "path": path})
+        return
+    if "http.response.zerocopy" in extensions:
+        with open(path, "rb") as file:
+            message = {"type": "http.response.zerocopy", "file": file, "offset": offset}
+            if count is not None:
+                message["count"] = count
+            await send(message)
+        return
+    await send_stream(receive, send, iter_file(path, offset, count))
+
+
+async def iter_file(
+    path: str, offset: int = 0, count: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        end = os.fstat(file.fileno()).st_size
+        if count is not None:
+            end = min(end, offset + count)
+        if end <= offset:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for start in range(offset, end, CHUNK_SIZE):
+                yield view[start : min(start + CHUNK_SIZE, end)]
+
+
+class StreamingBody:
+    """WSGI response iterable forwarding a streamed `requests` response.
+
+    Past the `time.monotonic` `deadline`, `TimeoutError` is raised between
+    two chunks, for the server to drop the connection.
+    """
+
+    def __init__(
+        self,
+        proxy_response,
+        chunk_size: Optional[int] = None,
+        release: Optional[Callable[[], None]] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.proxy_response = proxy_response
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.release = release
+        self.deadline = deadline
+
+    def __iter__(self) -> Iterator[bytes]:
+        chunks = self.proxy_response.iter_content(self.chunk_size)
+        if self.deadline is None:
+            return chunks
+        return self._until_deadline(chunks)
+
+    def _until_deadline(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            if timeouts.expired(self.deadline):
+                raise TimeoutError("Upstream body not received in time")
+            yield chunk
+
+    def close(self) -> None:
+        self.proxy_response.close()
+        if self.release is not None:
+            self.release()
+            self.release = None
@@ -0,0 +1,104 @@
+"""
+Upstream timeouts, by phase of a fetch, and deadlines set by the clients.
+
+Each phase of a fetch has its own limit, for all hosts unless overridden::
+
+    timeouts.overrides["slow.example.com"] = Timeouts(first_byte=30)
+
+A client may also tell how long it is willing to wait with a
+``X-Request-Timeout`` header, in seconds: the proxy then gives up on the
+upstream, and answers ``524``, as soon as the client would have given up
+itself, instead of keeping working for nobody.
+"""
+
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, Mapping, Optional, Tuple
+
+DEADLINE_HEADER = "x-request-timeout"
+
+# Smallest timeout given to the HTTP clients
+MIN_TIMEOUT = 0.001
+
+
+@dataclass
+class Timeouts:
+    # Seconds to resolve the host name and open a TCP connection
+    connect: float = 5.0
+    # ... to negotiate TLS on it
+    tls: float = 5.0
+    # ... to wait for a connection when the pool is full
+    pool: float = 5.0
+    # ... from the start of the fetch to the response headers
+    first_byte: float = 10.0
+    # ... to send the request, and between two reads of the response
+    read: float = 10.0
+    # ... for the whole fetch, body included; None for no limit
+    total: Optional[float] = None
+
+    def capped(self, deadline: Optional[float]) -> "Timeouts":
+        """Copy whose timeouts all end by the `deadline` of a client."""
+        if deadline is None:
+            return self
+        left = max(0.0, remaining(deadline))
+        total = left if self.total is None else min(self.total, left)
+        return replace(
+            self,
+            connect=min(self.connect, left),
+            tls=min(self.tls, left),
+            pool=min(self.pool, left),
+            first_byte=min(self.first_byte, left),
+            read=min(self.read, left),
+            total=total,
+        )
+
+    def requests_timeout(self) -> Tuple[float, float]:
+        """``timeout`` argument of `requests`, which only knows two phases."""
+        # requests refuses a zero timeout
+        connect = max(self.connect + self.tls, MIN_TIMEOUT)
+        return connect, max(min(self.first_byte, self.read), MIN_TIMEOUT)
+
+
+class DeadlineExceeded(Exception):
+    """The client has given up on the request already."""
+
+
+defaults = Timeouts()
+
+# By host name, or by host name and port
+overrides: Dict[str, Timeouts] = {}
+
+
+def get_timeouts(host: str) -> Timeouts:
+    timeouts = overrides.get(host)
+    if timeouts is None:
+        timeouts = overrides.get(host.rpartition(":")[0] or host, defaults)
+    return timeouts
+
+
+def client_deadline(headers: Mapping[str, str]) -> Optional[float]:
+    """`time.monotonic` deadline of the client, if it sent one."""
+    value = headers.get(DEADLINE_HEADER)
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if seconds != seconds or seconds < 0:
+        return None
+    return time.monotonic() + seconds
+
+
+def remaining(deadline: float) -> float:
+    return deadline - time.monotonic()
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and remaining(deadline) <= 0
+
+
+def check(deadline: Optional[float]) -> None:
+    """Raise `DeadlineExceeded` if the `deadline` has passed."""
+    if expired(deadline):
+        raise DeadlineExceeded()
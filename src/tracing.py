@@ -0,0 +1,154 @@
+"""
+Per-request phase tracing of the ASGI proxies.
+
+`TracingMiddleware` gives each request a `Trace`, and the proxy pipeline calls
+`mark` as the request reaches each of its phases, e.g.::
+
+    start  fetch  slot  dns  connect  tls  headers  response_start
+    upstream_body  response_end
+
+with the `time.perf_counter` time of each.  The time spent in a phase is the
+time between its mark and the previous one: ``connect`` is the TCP handshake,
+``headers`` the wait for the upstream response headers, ``response_end``
+sending the rest of the body downstream, and so on.  Phases that do not
+happen, such as the upstream ones of a cached response, have no mark.
+
+Finished traces are handed to the `hooks`.  Without hooks, tracing is off
+and `mark` costs a context variable lookup.  With ``MINIJ_TRACE_FILE`` set,
+a `SlowTraceExporter` hook appends the traces of the requests slower than
+``MINIJ_TRACE_SLOW_SECONDS`` to that file, as JSON lines.
+"""
+
+import json
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+# NDJSON file the traces of slow requests are appended to, if set
+TRACE_FILE = os.environ.get("MINIJ_TRACE_FILE")
+
+# Requests taking at least this many seconds are slow
+SLOW_SECONDS = float(os.environ.get("MINIJ_TRACE_SLOW_SECONDS", "1.0"))
+
+# Share of the slow requests written to the file
+SAMPLE_RATE = 1.0
+
+
+class Trace:
+    """Times at which a request reached each of its phases."""
+
+    def __init__(self, scope):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope["query_string"].decode("latin-1")
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.marks: List[Tuple[str, float]] = [("start", self.start)]
+        self.status: Optional[int] = None
+
+    def mark(self, phase: str) -> None:
+        self.marks.append((phase, time.perf_counter()))
+
+    def duration(self) -> float:
+        return self.marks[-1][1] - self.start
+
+    def phases(self) -> Dict[str, float]:
+        """Seconds spent in each phase, the phases of a kind added up."""
+        phases: Dict[str, float] = {}
+        for (_, previous), (phase, now) in zip(self.marks, self.marks[1:]):
+            phases[phase] = phases.get(phase, 0.0) + now - previous
+        return phases
+
+    def as_dict(self) -> dict:
+        return {
+            "time": self.time,
+            "method": self.method,
+            "path": self.path,
+            "query_string": self.query_string,
+            "status": self.status,
+            "duration": self.duration(),
+            "phases": self.phases(),
+            # Offsets from the start, in seconds
+            "marks": [(phase, t - self.start) for phase, t in self.marks],
+        }
+
+
+# Called with each finished trace
+hooks: List[Callable[[Trace], None]] = []
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def mark(phase: str) -> None:
+    """Record that the current request reached `phase`, if it is traced."""
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(phase)
+
+
+class SlowTraceExporter:
+    """Hook appending a sample of the traces of slow requests to a file.
+
+    Each trace is written with a single append, so that the workers of a
+    server can share the file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        threshold: float = SLOW_SECONDS,
+        sample_rate: float = SAMPLE_RATE,
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.exported = 0
+
+    def __call__(self, trace: Trace) -> None:
+        if trace.duration() < self.threshold:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace.as_dict()) + "\n"
+        try:
+            with open(self.path, "a") as file:
+                file.write(line)
+        except OSError:
+            # Tracing must not break the proxy
+            return
+        self.exported += 1
+
+
+if TRACE_FILE:
+    hooks.append(SlowTraceExporter(TRACE_FILE))
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing the HTTP requests while there are `hooks`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not hooks or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope)
+
+        async def send_traced(message) -> None:
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                trace.mark("response_start")
+            await send(message)
+
+        token = _current.set(trace)
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            _current.reset(token)
+            trace.mark("response_end")
+            for hook in hooks:
+                hook(trace)
@@ -0,0 +1,281 @@
+"""
+Process-wide pooled upstream clients, shared by the ASGI proxies.
+
+Each worker process owns one ``httpx.AsyncClient`` (and, lazily, one
+``aiohttp.ClientSession``), created on ASGI ``lifespan.startup`` and closed on
+``lifespan.shutdown``, so proxied requests reuse warm keep-alive connections
+instead of paying a new TCP/TLS handshake every time.
+
+Both connect to the addresses of the shared `dnscache.resolver`, so opening a
+new connection does not wait for the system resolver either.
+
+The httpx client may also talk HTTP/2 to the upstreams (see `PROTOCOL`): the
+concurrent requests to an origin are then streams multiplexed on a single
+connection, and `hostlimits` bounds the streams in flight per origin.
+"""
+
+import os
+import socket
+import ssl
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import anyio
+import anyio.abc
+import httpcore
+import httpx
+from anyio.streams.tls import TLSStream
+
+try:
+    # Private to httpcore, whose version is pinned for it in pyproject.toml
+    from httpcore._backends.anyio import AnyIOBackend, SocketStream
+except ImportError:
+    AnyIOBackend = SocketStream = None
+
+import dnscache
+import hostlimits
+import metrics
+import timeouts
+import tracing
+
+# Protocol of the httpx client: "http1" for a pool of HTTP/1.1 connections,
+# "http2" for HTTP/2 only (with prior knowledge on cleartext connections), or
+# "auto" for HTTP/2 with the origins offering it by TLS ALPN
+PROTOCOLS = ("http1", "http2", "auto")
+PROTOCOL = os.environ.get("MINIJ_UPSTREAM_PROTOCOL", "http1")
+
+
+@dataclass
+class PoolLimits:
+    # Total number of connections to all upstreams; those to a single host
+    # are bounded by the requests `hostlimits` lets through to it
+    max_connections: int = 100
+    # Idle keep-alive connections are closed after this many seconds
+    keepalive_expiry: float = 5.0
+
+
+limits = PoolLimits()
+
+_httpx_client: Optional[httpx.AsyncClient] = None
+_aiohttp_session = None
+
+
+class CachedDNSBackend(AnyIOBackend or object):
+    """httpcore network backend resolving host names with `dnscache`.
+
+    TLS is negotiated with the host name, for SNI and certificate checks,
+    within the `timeouts.Timeouts.tls` of the host.  Certificate and other
+    TLS errors stay the cause of the `httpcore.ConnectError`, for
+    `error_status` to tell them apart.
+    """
+
+    async def open_tcp_stream(
+        self,
+        hostname: bytes,
+        port: int,
+        ssl_context: Optional[ssl.SSLContext],
+        timeout: Dict[str, Optional[float]],
+        *,
+        local_address: Optional[str],
+    ) -> SocketStream:
+        host = hostname.decode("utf-8")
+        start = time.perf_counter()
+        try:
+            with anyio.fail_after(timeout.get("connect")):
+                addresses = await dnscache.resolver.resolve(host, port)
+                tracing.mark("dns")
+                stream = await connect_tcp(addresses, port, local_address)
+                tracing.mark("connect")
+            if ssl_context:
+                tls_timeout = timeouts.get_timeouts(f"{host}:{port}").tls
+                with anyio.fail_after(tls_timeout):
+                    stream = await TLSStream.wrap(
+                        stream,
+                        hostname=host,
+                        ssl_context=ssl_context,
+                        standard_compatible=False,
+                    )
+                tracing.mark("tls")
+        except TimeoutError as e:
+            raise httpcore.ConnectTimeout(e) from None
+        except ssl.SSLError as e:
+            raise httpcore.ConnectError(e) from e
+        except (OSError, anyio.BrokenResourceError) as e:
+            raise httpcore.ConnectError(e) from None
+        metrics.upstream_connect.observe(time.perf_counter() - start)
+        return SocketStream(stream=stream)
+
+
+async def connect_tcp(
+    addresses: List[dnscache.AddressInfo], port: int, local_address: Optional[str]
+) -> anyio.abc.SocketStream:
+    """Connect to the first of `addresses` accepting the connection."""
+    error: Optional[OSError] = None
+    for *_, sockaddr in addresses:
+        try:
+            return await anyio.connect_tcp(sockaddr[0], port, local_host=local_address)
+        except OSError as e:
+            error = e
+    raise error or OSError(f"No address to connect to on port {port}")
+
+
+class CachedDNSResolver:
+    """aiohttp resolver answering from `dnscache`."""
+
+    async def resolve(
+        self, host: str, port: int = 0, family: int = socket.AF_INET
+    ) -> List[dict]:
+        addresses = await dnscache.resolver.resolve(host, port, family)
+        return [
+            {
+                "hostname": host,
+                "host": sockaddr[0],
+                "port": sockaddr[1],
+                "family": address_family,
+                "proto": proto,
+                "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            }
+            for address_family, _, proto, _, sockaddr in addresses
+        ]
+
+    async def close(self) -> None:
+        pass
+
+
+def make_httpx_client() -> httpx.AsyncClient:
+    if PROTOCOL not in PROTOCOLS:
+        raise ValueError(f"Unknown upstream protocol: {PROTOCOL!r}")
+    transport = httpx.AsyncHTTPTransport(
+        http1=PROTOCOL != "http2",
+        # Needs the h2 package
+        http2=PROTOCOL != "http1",
+        limits=httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+        ),
+        # httpcore takes a backend instance as well as a name; without the
+        # one of its private classes, the names are resolved by the system
+        backend=CachedDNSBackend() if AnyIOBackend is not None else "anyio",
+    )
+    return httpx.AsyncClient(transport=transport)
+
+
+def pool_samples() -> Iterable[metrics.Sample]:
+    """`metrics` samples of the connections of the httpx client's pool."""
+    connections: Optional[list] = []
+    if _httpx_client is not None and not _httpx_client.is_closed:
+        # Neither httpx nor httpcore tell the state of their pool: the
+        # private attributes of httpcore 0.13 are read if they are there
+        pool = getattr(_httpx_client._transport, "_pool", None)
+        groups = getattr(pool, "_connections", None)
+        connections = None
+        if isinstance(groups, dict):
+            connections = [c for group in list(groups.values()) for c in group]
+    if connections is not None:
+        idle = sum(1 for connection in connections if connection.is_idle())
+        yield "minij_upstream_connections", metrics.label("state", "idle"), idle
+        active = len(connections) - idle
+        yield "minij_upstream_connections", metrics.label("state", "active"), active
+    yield "minij_upstream_max_connections", "", limits.max_connections
+
+
+metrics.collectors.append(pool_samples)
+
+
+def make_aiohttp_session():
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=limits.max_connections,
+        keepalive_timeout=limits.keepalive_expiry,
+        # Cached by dnscache instead
+        use_dns_cache=False,
+        resolver=CachedDNSResolver(),
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def get_httpx_client() -> httpx.AsyncClient:
+    """Return the worker's shared client.
+
+    The client is normally created on lifespan startup, but servers running
+    with lifespan disabled get one lazily on the first request.
+    """
+    global _httpx_client
+    if _httpx_client is None or _httpx_client.is_closed:
+        _httpx_client = make_httpx_client()
+    return _httpx_client
+
+
+def get_aiohttp_session():
+    global _aiohttp_session
+    if _aiohttp_session is None or _aiohttp_session.closed:
+        _aiohttp_session = make_aiohttp_session()
+    return _aiohttp_session
+
+
+def error_status(e: httpx.HTTPError) -> int:
+    """Map an httpx exception to the status code returned downstream."""
+    if caused_by(e, ssl.SSLError):
+        # Invalid SSL Certificate
+        return 526
+    if isinstance(e, httpx.TimeoutException):
+        return 524
+    if isinstance(e, httpx.TooManyRedirects):
+        return 520
+    return 523
+
+
+def caused_by(e: BaseException, kind: type) -> bool:
+    """Whether `e`, or any exception it was raised from, is a `kind`.
+
+    httpx raises its exceptions from those of httpcore, which hold the error
+    of the network backend as their argument, so the whole chain is searched.
+    """
+    pending: List[Optional[BaseException]] = [e]
+    seen = set()
+    while pending:
+        error = pending.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, kind):
+            return True
+        pending += [error.__cause__, error.__context__]
+        pending += [arg for arg in error.args if isinstance(arg, BaseException)]
+    return False
+
+
+async def startup() -> None:
+    get_httpx_client()
+
+
+async def shutdown() -> None:
+    global _httpx_client, _aiohttp_session
+    if _httpx_client is not None:
+        await _httpx_client.aclose()
+        _httpx_client = None
+    if _aiohttp_session is not None:
+        await _aiohttp_session.close()
+        _aiohttp_session = None
+    hostlimits.reset()
+    dnscache.resolver.clear()
+
+
+async def handle_lifespan(scope, receive, send) -> None:
+    """Answer the ASGI lifespan protocol for raw ASGI applications."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+            else:
+                await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src/ are top-level modules, as in the servers' --app-dir
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
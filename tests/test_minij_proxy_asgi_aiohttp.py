@@ -0,0 +1,52 @@
+import asyncio
+from urllib.parse import quote
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+import minij_proxy_asgi_aiohttp
+import origin
+import upstream
+
+
+async def fetch_status(query: str) -> int:
+    """Status returned for an origin request with `query`."""
+    simulated = origin.Origin(origin.Profile())
+    server = await asyncio.start_server(simulated.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    url = quote(f"http://127.0.0.1:{port}/?{query}", safe="")
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "query_string": f"url={url}".encode(),
+        "headers": [],
+    }
+    try:
+        response = await minij_proxy_asgi_aiohttp.fetch_content(
+            upstream.get_aiohttp_session(), Request(scope)
+        )
+        if isinstance(response, StreamingResponse):
+            async for _ in response.body_iterator:
+                pass
+    finally:
+        await upstream.shutdown()
+        server.close()
+        await server.wait_closed()
+    return response.status_code
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.parametrize(
+    "query, status",
+    [
+        ("size=10", 200),
+        ("error_rate=1&error_status=404", 404),
+        ("error_rate=1&error_status=500", 520),
+    ],
+)
+def test_upstream_status_is_passed_through(monkeypatch, streaming, query, status):
+    monkeypatch.setattr(minij_proxy_asgi_aiohttp.streaming, "STREAMING", streaming)
+
+    assert asyncio.run(fetch_status(query)) == status
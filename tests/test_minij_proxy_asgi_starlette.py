@@ -0,0 +1,17 @@
+import pytest
+from starlette.testclient import TestClient
+
+import hostlimits
+import minij_proxy_asgi_starlette
+
+
+@pytest.mark.parametrize("path", ["/", "/proxy"])
+def test_proxy_is_served(monkeypatch, path):
+    # Answered without reaching the host
+    limits = hostlimits.HostLimits(max_concurrency=0, max_queue=0)
+    monkeypatch.setitem(hostlimits.overrides, "shed.invalid", limits)
+    client = TestClient(minij_proxy_asgi_starlette.app)
+
+    response = client.get(path, params={"url": "http://shed.invalid/"})
+
+    assert response.status_code == 503
@@ -0,0 +1,17 @@
+import werkzeug
+import werkzeug.test
+
+import hostlimits
+import minij_proxy_werkzeug
+
+
+def test_shed_request_gets_503(monkeypatch):
+    # No request may go through nor wait for the host
+    limits = hostlimits.HostLimits(max_concurrency=0, max_queue=0)
+    monkeypatch.setitem(hostlimits.overrides, "shed.invalid", limits)
+    client = werkzeug.test.Client(minij_proxy_werkzeug.application, werkzeug.Response)
+
+    response = client.get("/?url=http://shed.invalid/")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(hostlimits.RETRY_AFTER)
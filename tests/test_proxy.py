@@ -0,0 +1,49 @@
+import asyncio
+
+import origin
+import proxy
+import upstream
+
+JOINERS = 4
+
+
+async def read(response: proxy.ProxyResponse) -> bytes:
+    if response.stream is None:
+        return response.body
+    return b"".join([chunk async for chunk in response.stream])
+
+
+async def fetch_concurrently(query: str):
+    """Origin requests and collapsed count of 1 + `JOINERS` identical fetches."""
+    simulated = origin.Origin(origin.Profile())
+    server = await asyncio.start_server(simulated.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/?latency=0.2&{query}"
+    await upstream.startup()
+    collapsed = proxy.flights.collapsed
+    try:
+        responses = await asyncio.gather(
+            *[proxy.fetch(url, {}) for _ in range(1 + JOINERS)]
+        )
+        bodies = await asyncio.gather(*[read(response) for response in responses])
+    finally:
+        await upstream.shutdown()
+        server.close()
+        await server.wait_closed()
+    assert all(response.status == 200 for response in responses)
+    assert len(set(bodies)) == 1
+    return simulated.requests, proxy.flights.collapsed - collapsed
+
+
+def test_cacheable_fetches_are_collapsed(monkeypatch):
+    monkeypatch.setattr(proxy, "DISK_CACHING", False)
+    requests, collapsed = asyncio.run(fetch_concurrently("cache_headers=1"))
+    assert requests == 1
+    assert collapsed == JOINERS
+
+
+def test_uncacheable_fetches_are_not_collapsed(monkeypatch):
+    monkeypatch.setattr(proxy, "DISK_CACHING", False)
+    requests, collapsed = asyncio.run(fetch_concurrently("cache_headers=0"))
+    assert requests == 1 + JOINERS
+    assert collapsed == 0
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import metrics
+import streaming
+
+
+async def failing_body(error: Exception):
+    yield b"first"
+    raise error
+
+
+def send_failing_body(error: Exception):
+    """Messages sent for a body failing after its first chunk."""
+    sent = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(streaming.send_stream(receive, send, failing_body(error)))
+    return sent
+
+
+@pytest.mark.parametrize(
+    "error, cause",
+    [
+        (TimeoutError("Upstream body not received in time"), "timeout"),
+        (httpx.ReadError("Connection reset"), "read"),
+    ],
+)
+def test_failed_body_is_cut_short(monkeypatch, error, cause):
+    monkeypatch.setattr(metrics, "body_errors", {})
+
+    sent = send_failing_body(error)
+
+    # Without the last message, the server drops the connection
+    assert [message["more_body"] for message in sent] == [True]
+    assert metrics.body_errors == {cause: 1}
+
+
+class DrippingResponse:
+    def iter_content(self, chunk_size):
+        while True:
+            time.sleep(0.01)
+            yield b"x"
+
+    def close(self):
+        pass
+
+
+def test_streaming_body_stops_at_deadline():
+    body = streaming.StreamingBody(DrippingResponse(), deadline=time.monotonic() + 0.05)
+
+    with pytest.raises(TimeoutError):
+        for _ in body:
+            pass